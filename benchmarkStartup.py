@@ -0,0 +1,78 @@
+"""
+Measures the start up time of the scripts which are called by run_SOMA.py,
+i.e. the time python needs to import everything a script needs on a real
+run before it starts working. With --profile the modules which take
+longest to import are listed (python -X importtime)."""
+
+from __future__ import print_function
+from optparse import OptionParser
+from subprocess import Popen, PIPE
+import os
+import sys
+import time
+
+
+PYPLOT = 'from func import pyplot; pyplot()'
+
+# Imports of each script on its main path, in the order they happen
+SCRIPTS = {'checkAsync.py': ['import checkAsync'],
+           'checkCalibration.py': ['import checkCalibration', 'import concurrent.futures'],
+           'plotBPMcolormap.py': ['import plotBPMcolormap', PYPLOT],
+           'plotBPMCalibEstHist.py': ['import plotBPMCalibEstHist'],
+           'plotFrequency.py': ['import plotFrequency'],
+           'plotOptics.py': ['import plotOptics'],
+           'plotSDDS.py': ['import plotSDDS'],
+           'cutSDDS.py': ['import cutSDDS'],
+           'harmonicNumpy.py': ['import harmonicNumpy'],
+           # run_SOMA.py starts its work when imported, the scripts above are imported by its stages
+           'run_SOMA.py': ['import func', 'import pipeline']}
+
+
+def startup_time(python_exe, script, repeat):
+    """
+    Returns the median wall time of repeat starts of python importing
+    what script imports on a real run.
+    """
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        p = Popen([python_exe, '-c', '\n'.join(SCRIPTS[script])], stdout=PIPE, stderr=PIPE)
+        p.communicate()
+        times.append(time.time() - start)
+    return sorted(times)[len(times) // 2]
+
+
+def slowest_imports(python_exe, script, number=5):
+    """
+    Returns the modules with the longest cumulative import time
+    (in seconds) of what script imports on a real run.
+    """
+    p = Popen([python_exe, '-X', 'importtime', '-c', '\n'.join(SCRIPTS[script])], stdout=PIPE, stderr=PIPE)
+    out, err = p.communicate()
+    imports = []
+    for line in err.decode().splitlines():
+        if line.startswith('import time:') and '|' in line:
+            self_time, cumulative, module = line[len('import time:'):].split('|')
+            if cumulative.strip().isdigit() and not module.startswith('   '):
+                imports.append((int(cumulative) * 1e-6, module.strip()))
+    return sorted(imports, reverse=True)[:number]
+
+
+if __name__ == "__main__":
+
+    parser = OptionParser()
+    parser.add_option("-p", "--python",  dest="python", help="Python executable.", action="store", default=sys.executable)
+    parser.add_option("-r", "--repeat",  dest="repeat", help="Number of starts per script.", action="store", type=int, default=5)
+    parser.add_option("-i", "--profile",  dest="profile", help="List the slowest imports of each script.", action="store_true", default=False)
+    (options, args) = parser.parse_args()
+
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    total = 0
+    for script in (args or sorted(SCRIPTS)):
+        tt = startup_time(options.python, script, options.repeat)
+        total += tt
+        print(script.ljust(28) + '%7.3f s' % tt)
+        if options.profile:
+            for cumulative, module in slowest_imports(options.python, script):
+                print('    ' + module.ljust(24) + '%7.3f s' % cumulative)
+    print('Total'.ljust(28) + '%7.3f s' % total)
@@ -1,99 +1,159 @@
 """
 Script for analysing synchronisation of BPMs from total phase advance measurement.
 This script outputs a text file discribing the number of turns each BPM is out of synch by.
+The total phase advances of all measurement runs are joined by name on the BPMs
+of the model into one BPM x run matrix, which is classified at once.
+Additionally consensus.txt holds the offset of each BPM most runs agree on,
+to convert all runs with the same offsets, and consensus.tfs the votes.
 
 """
 from __future__ import print_function
-import sys
 import os
+import warnings
 import numpy as np
 import argparse
-from func import read_phase, read_phasetot, read_bpms
-
-# Argument parser.
-parser = argparse.ArgumentParser()
-parser.add_argument('--optics_output_dir', '-ood', dest="ood", action="store")
-parser.add_argument('--async_output_dir', '-aod', dest="aod", action="store")
-parser.add_argument('--axis', '-ax', dest="axis", choices = ('x', 'y') ,action="store")
-parser.add_argument('--ring', '-r', dest="ring", choices = ('her', 'ler'), action="store")
-parser.add_argument('--sdds', '-s', dest="sdds", action="store")
-args = parser.parse_args()
-
-
-# Check if phase output directory exists, if not, exit.
-if not os.path.exists(args.ood):
-    print("Directory", args.ood, "not found.")
-    sys.exit()
-# Check if output dir for the present script exists, if not, create one.
-if not os.path.exists(args.aod):
-    os.system("mkdir " + args.aod)
-
-# Check for asynchronous BPMs in each measurement reun using phase output.
-for count, run in enumerate(os.listdir(args.ood)):
-    datapath = os.path.join(args.ood, run)
-    # try:
-        # S, names, deltaph, phx, phxmdl, Qx, Qy = phase(datapath, args.axis)
-    # except IOError:
-    #     continue
-
-    namesmdl = read_bpms(args.sdds)
-    names, Qx, Qy = read_phase(datapath, args.axis)
-    deltaphtot = read_phasetot(datapath, args.axis)
-    
-    level = []
-    deltaQ = 0.90
-    deltaQ2 = 0.10 
-
-    tune = (1.-Qx) if args.axis == 'x' else (1.-Qy)
-    #tune = (Qx) if args.axis == 'x' else (Qy)
-    j=0
-    i=0
-    while j < len(namesmdl):
-        try:
-            if namesmdl[j] in names[i]:
-                if deltaphtot[i] / tune >= deltaQ:
-                    level.append('-1') if args.ring == 'her' else level.append('+1') 
-                elif deltaphtot[i] / tune <= -deltaQ:
-                    level.append('+1') if args.ring == 'her' else level.append('-1')
-                elif deltaphtot[i] / tune >= (deltaQ-deltaQ2):
-                    level.append('-1') if args.ring == 'her' else level.append('+1') 
-                elif deltaphtot[i] / tune <= -(deltaQ-deltaQ2):
-                    level.append('+1') if args.ring == 'her' else level.append('-1')
-                elif deltaphtot[i] / tune >= deltaQ2: 
-                    level.append('+2') if args.ring == 'her' else  level.append('-2')
-                elif deltaphtot[i] / tune <= -deltaQ2: 
-                    level.append('-2') if args.ring == 'her' else level.append('+2')
-                else:
-                    level.append('0')
-            else:
-                level.append('u')
-                i=i-1
-            i=i+1
-            j=j+1
-        except IndexError:
-            break
-    #print('\n')                
-    while len(level) < len(namesmdl): level.append('0')
-
-    for i in range(len(level)):
-        if 1 < i < len(level)-1:
-            if (level[i-1] == level[i+1]) != 'u' : 
-                if level[i] == 'u': level[i] = level[i-1]
-            else: level[i] = '0'
-    
-    for i in range(len(level)):
-        if level[i] == 'u': level[i]='0'
-    #print(level)
-    file = open(args.aod + run + '.txt', 'w')
-    file.write('{\n')
-
-    # try:
-    for i in range(len(level)):
-        file.write('"' + namesmdl[i] + '"->' + level[i] + ',\n')
-    file.write('}')
-    # except IndexError:
-        # print(run)
-    file.close()
-    # quit()
-
-sys.exit()
+from func import read_phase, read_phasetot, read_bpms, write_tfs
+
+
+DELTAQ = 0.90
+DELTAQ2 = 0.10
+
+
+def phase_matrix(optics_output_dir, runs, namesmdl, axis):
+    """
+    Returns the total phase advance deviation in units of the tune of each
+    model BPM (rows) in each run (columns), NaN where a BPM is not in the
+    phase output, and whether a BPM is in the phase output.
+    """
+    index = dict((name, j) for j, name in enumerate(namesmdl))
+    ratio = np.full((len(namesmdl), len(runs)), np.nan)
+    matched = np.zeros(ratio.shape, dtype=bool)
+
+    for k, run in enumerate(runs):
+        datapath = os.path.join(optics_output_dir, run)
+        Qx, Qy = read_phase(datapath, axis)[1:]
+        # names and phases from the same file, joined by name on the model BPMs
+        names, deltaphtot = read_phasetot(datapath, axis, names=True)
+        deltaphtot = np.asarray(deltaphtot, dtype=float)
+
+        tune = (1.-Qx) if axis == 'x' else (1.-Qy)
+        #tune = (Qx) if axis == 'x' else (Qy)
+        rows = np.array([index.get(name, -1) for name in names], dtype=int)
+        found = rows >= 0
+        ratio[rows[found], k] = deltaphtot[found] / tune
+        matched[rows[found], k] = True
+
+    return ratio, matched
+
+
+def classify(ratio, matched, ring):
+    """
+    Returns the number of turns each BPM (rows) is out of synch by in each
+    run (columns): -1/+1 for a phase advance deviation of about one tune,
+    +2/-2 for deviations above DELTAQ2 which are not a full turn, 0 otherwise
+    (signs for the HER, the other way round for the LER).
+    BPMs missing in the phase output take the level of the BPM before them,
+    BPMs after the last measured one and at the ends of the ring are 0.
+    """
+    sign = 1 if ring == 'her' else -1
+    level = sign * np.select([ratio >= (DELTAQ-DELTAQ2), ratio <= -(DELTAQ-DELTAQ2), ratio >= DELTAQ2, ratio <= -DELTAQ2],
+                             [-1, 1, 2, -2], 0)
+
+    n = len(level)
+    rows = np.arange(n)[:, None]
+    last = np.where(matched.any(axis=0), n - 1 - np.argmax(matched[::-1], axis=0), -1)
+    unknown = ~matched & (rows <= last)
+
+    # unknown BPMs are filled from the closest BPM before them, except at the ends
+    source = ~unknown
+    source[:2] = True
+    source[n-1:] = True
+    fill = np.maximum.accumulate(np.where(source, rows, 0), axis=0)
+    runs = np.arange(level.shape[1])
+    level = np.where(unknown[fill, runs], 0, level[fill, runs])
+    return level
+
+
+def consensus(level, matched, min_vote=0.5):
+    """
+    Returns the offset of each BPM (rows of level) which most of the runs
+    it is measured in agree on, the fraction of these runs and their number.
+    Offsets with less than min_vote of the votes are set to 0, and so are
+    ties, i.e. when several offsets have the most votes.
+    """
+    offsets = np.array([0, -1, 1, -2, 2])
+    votes = np.array([np.sum((level == off) & matched, axis=1) for off in offsets])
+    nruns = matched.sum(axis=1)
+    top = votes.max(axis=0)
+    unique = np.sum(votes == top, axis=0) == 1
+    fraction = top / np.maximum(nruns, 1).astype(float)
+    offset = np.where(unique & (fraction >= min_vote), offsets[np.argmax(votes, axis=0)], 0)
+    return offset, fraction, nruns
+
+
+def write_levels(file, namesmdl, level):
+    """
+    Writes the level of each BPM as SAD rule list.
+    """
+    with open(file, 'w') as f:
+        f.write('{\n')
+        for name, lev in zip(namesmdl, level):
+            f.write('"' + name + '"->' + ('%+d' % lev if lev else '0') + ',\n')
+        f.write('}')
+
+
+def check_async(optics_output_dir, async_output_dirs, sdds, ring, min_vote=0.5):
+    """
+    Writes <run>.txt with the level of each BPM for every run in optics_output_dir
+    to async_output_dirs[axis], for each plane in async_output_dirs, and the
+    levels of all runs together to consensus.txt and consensus.tfs.
+    The average folder of the all files analysis is left out.
+    """
+    # Check if phase output directory exists, if not, stop.
+    if not os.path.exists(optics_output_dir):
+        print("Directory", optics_output_dir, "not found.")
+        return
+
+    # BPMs of the model, the same for all measurement runs
+    namesmdl = read_bpms(sdds)
+    # the all files analysis (average) is not a measurement run of its own
+    runs = sorted(run for run in os.listdir(optics_output_dir)
+                  if os.path.isdir(os.path.join(optics_output_dir, run)) and run != 'average')
+
+    for axis in sorted(async_output_dirs):
+        # Check if output dir for the present plane exists, if not, create one.
+        if not os.path.exists(async_output_dirs[axis]):
+            os.makedirs(async_output_dirs[axis])
+
+        ratio, matched = phase_matrix(optics_output_dir, runs, namesmdl, axis)
+        level = classify(ratio, matched, ring)
+        for k, run in enumerate(runs):
+            write_levels(os.path.join(async_output_dirs[axis], run + '.txt'), namesmdl, level[:, k])
+
+        offset, fraction, nruns = consensus(level, matched, min_vote)
+        write_levels(os.path.join(async_output_dirs[axis], 'consensus.txt'), namesmdl, offset)
+        with warnings.catch_warnings():
+            # BPMs which are not measured in any run have no median
+            warnings.simplefilter('ignore', RuntimeWarning)
+            median = np.nanmedian(ratio, axis=1) if len(runs) else np.full(len(namesmdl), np.nan)
+        write_tfs(os.path.join(async_output_dirs[axis], 'consensus.tfs'), {'RUNS': len(runs), 'MIN_VOTE': min_vote},
+                  {'NAME': np.array(namesmdl), 'OFFSET': offset, 'VOTE': fraction, 'NRUNS': nruns, 'MEDIAN_DELTAPHASE': median})
+        print('Consensus offsets (' + axis + '): ' + str(np.count_nonzero(offset)) + ' out of phase BPMs, ' +
+              str(np.count_nonzero((nruns > 0) & (fraction < 1))) + ' BPMs with disagreeing runs.')
+
+
+if __name__ == "__main__":
+
+    # Argument parser.
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--optics_output_dir', '-ood', dest="ood", action="store")
+    parser.add_argument('--async_output_dir', '-aod', dest="aod", nargs='+', help="One output folder per plane in --axis.")
+    parser.add_argument('--axis', '-ax', dest="axis", choices = ('x', 'y'), nargs='+', default=['x', 'y'])
+    parser.add_argument('--ring', '-r', dest="ring", choices = ('her', 'ler'), action="store")
+    parser.add_argument('--sdds', '-s', dest="sdds", action="store")
+    parser.add_argument('--min_vote', dest="min_vote", type=float, default=0.5, help="Fraction of runs needed for a consensus offset.")
+    args = parser.parse_args()
+
+    if len(args.aod) != len(args.axis):
+        parser.error('Give one --async_output_dir per plane in --axis.')
+    check_async(args.ood, dict(zip(args.axis, args.aod)), args.sdds, args.ring, args.min_vote)
@@ -1,7 +1,10 @@
 """
 Calculated BPM calibration by using beta_phase and 
 beta_amplitude. Calibration factors are applied to lin files
-and written in a new folder.
+by BPM name and written in a new folder.
+The beta functions of all runs are aligned by BPM name into
+run x BPM arrays, from which the calibration factors of all BPMs
+are computed at once with masked arrays.
 """
 
 from __future__ import print_function
@@ -9,103 +12,138 @@ from optparse import OptionParser
 import numpy as np 
 import os
 import pandas
-from func import get_dict_colormap, read_bpms, read_bet_phase, read_bet_amp, reject_outliers
-import sys
+import tfs
+from func import align_on_bpms, load_tfs, read_bpms
+from robustStats import clipped_mean
 # sys.path.append('/afs/cern.ch/work/j/jkeintze/public/Beta-Beat.src/')
 # from tfs_files import tfs_pandas
-import tfs
-
-
-
-
-if __name__ == "__main__":
-    
-    parser = OptionParser()
-    parser.add_option("-s", "--sdds",  dest="sdds", help="Folder of sdds files, leades to other folders.", action="store")
-    parser.add_option("-p", "--plane",  dest="plane", help="Transverse plane, either x or y.", action="store")
-    parser.add_option("-r", "--ring",  dest="ring", help="Ring ID, HER or LER", action="store")
-    (options, args) = parser.parse_args()
-
-    all_sdds = [sd for sd in os.listdir(options.sdds) if '.sdds' in sd[-5:]]
-    all_bpms = read_bpms(os.path.join(options.sdds, all_sdds[0]))
-
-    synched_harmonic_output = os.path.join(options.sdds[:-13], 'synched_harmonic')
-    synched_phase_output = os.path.join(options.sdds[:-13], 'synched_optics')
-    calibrated_harmonic_output = os.path.join(options.sdds[:-13], 'calibrated_harmonic')
-
-
-    df = {}
-    df2 = {}
-  
-
-    for sdds in all_sdds:
-        df[sdds] = []
-        df2[sdds] = []
-
-        folder = os.path.join(synched_phase_output, sdds)
-        beta_phase, beta_phase_err, bpms = read_bet_phase(folder, options.plane)
-        beta_amp, beta_amp_err = read_bet_amp(folder, options.plane)
-            
-
-        cal = [(beta_phase[i]/beta_amp[i]) for i in range(len(beta_phase))]
-        cal_err = [(beta_phase_err[i]**2 / (4*beta_amp[i]*beta_phase[i]) + beta_amp_err[i]**2 * beta_phase[i] / (4*beta_amp[i]**3)) for i in range(len(beta_phase))]
-        
-        for bpm in all_bpms:
-            try:
-                df[sdds].append(get_dict_colormap(bpms, cal)[bpm])
-                df2[sdds].append(get_dict_colormap(bpms, cal_err)[bpm])
-            except KeyError:
-                df[sdds].append(np.nan)
-                df2[sdds].append(np.nan)
-
 
-    df = pandas.DataFrame(df, index=all_bpms)
-    df=df.T
-    df2 = pandas.DataFrame(df2, index=all_bpms)
-    df2=df2.T
 
-    tfs.write(options.sdds + '../CalibrationSquareBPM_'+options.plane+'.tfs', df, save_index=True)
-    tfs.write(options.sdds + '../CalibrationErrorSquareBPM_'+options.plane+'.tfs', df, save_index=True)
-
-    av_cal_bpms = []
-    av_cal_err_bpms = []
-
-    for bpm in all_bpms:
-        av_cal = [np.sqrt(df[bpm][i]) for i in range(len(all_sdds)) if not np.isnan(df[bpm][i]) and df[bpm][i] >= 0  ]
-        av_cal_err = [np.sqrt(df2[bpm][i]) for i in range(len(all_sdds)) if not np.isnan(df2[bpm][i]) and df2[bpm][i] >= 0 ]
+def read_beta(folder, kind, plane, all_bpms):
+    """
+    Reads beta_<kind>_<plane>.tfs and returns the beta function
+    and its error aligned on all_bpms.
+    """
+    table = load_tfs(os.path.join(folder, 'beta_' + kind + '_' + plane + '.tfs'))[1]
+    return (align_on_bpms(all_bpms, table['NAME'], table['BET' + plane.upper()]),
+            align_on_bpms(all_bpms, table['NAME'], table['ERRBET' + plane.upper()]))
+
+
+def calibration_square(phase_output, all_sdds, all_bpms, plane):
+    """
+    Returns beta_phase/beta_amp and its error for each run (rows)
+    and BPM (columns), NaN where a BPM is missing.
+    """
+    cal = np.full((len(all_sdds), len(all_bpms)), np.nan)
+    cal_err = np.full(cal.shape, np.nan)
+    for k, sdds in enumerate(all_sdds):
+        folder = os.path.join(phase_output, sdds)
+        beta_phase, beta_phase_err = read_beta(folder, 'phase', plane, all_bpms)
+        beta_amp, beta_amp_err = read_beta(folder, 'amplitude', plane, all_bpms)
+
+        cal[k] = beta_phase/beta_amp
+        cal_err[k] = beta_phase_err**2 / (4*beta_amp*beta_phase) + beta_amp_err**2 * beta_phase / (4*beta_amp**3)
+    return cal, cal_err
+
+
+def estimate_calibration(sdds_dir, plane):
+    """
+    Computes the calibration of each BPM from the synched optics and
+    writes it to calibration_<plane>.tfs next to sdds_dir.
+    Returns it as DataFrame.
+    """
+
+    all_sdds = [sd for sd in os.listdir(sdds_dir) if '.sdds' in sd[-5:]]
+    all_bpms = read_bpms(os.path.join(sdds_dir, all_sdds[0]))
+    synched_phase_output = os.path.join(sdds_dir[:-13], 'synched_optics')
+
+    cal, cal_err = calibration_square(synched_phase_output, all_sdds, all_bpms, plane)
+    df = pandas.DataFrame(cal, index=all_sdds, columns=all_bpms)
+    df2 = pandas.DataFrame(cal_err, index=all_sdds, columns=all_bpms)
+    tfs.write(sdds_dir + '../CalibrationSquareBPM_'+plane+'.tfs', df, save_index=True)
+    tfs.write(sdds_dir + '../CalibrationErrorSquareBPM_'+plane+'.tfs', df2, save_index=True)
+
+    # mean over the runs of the square roots without outliers, 1 where nothing is left
+    calibration = clipped_mean(np.sqrt(np.where(cal >= 0, cal, np.nan)), fill=1.)
+    error_calibration = clipped_mean(np.sqrt(np.where(cal_err >= 0, cal_err, np.nan)), fill=1.)
+    df_calibration = pandas.DataFrame({'NAME': all_bpms, 'CALIBRATION': calibration,
+                                       'ERROR_CALIBRATION': error_calibration}, columns=['NAME', 'CALIBRATION', 'ERROR_CALIBRATION'])
+    tfs.write(sdds_dir + '../calibration_'+plane+'.tfs', df_calibration, save_index=False)
+    return df_calibration
+
+
+def calibrate_run(task):
+    """
+    Reads the lin files of one measurement run, multiplies the amplitudes
+    of each BPM by its calibration (matched by NAME, 1 for BPMs without
+    calibration) and writes them to the calibrated folder, for
+    task = (run prefix, synched folder, calibrated folder, {plane: calibration}).
+    """
+    prefix, synched_harmonic_output, calibrated_harmonic_output, calibrations = task
+    for plane in sorted(calibrations):
+        lin = prefix + 'lin' + plane
+        if not os.path.isfile(os.path.join(synched_harmonic_output, lin)):
+            continue
+        calibration = calibrations[plane].set_index('NAME')
+        df_lin = tfs.read(os.path.join(synched_harmonic_output, lin))
+        factor = df_lin['NAME'].map(calibration['CALIBRATION']).fillna(1.)
+        error = df_lin['NAME'].map(calibration['ERROR_CALIBRATION']).fillna(1.)
+        df_lin['AMP'+plane.upper()] = df_lin['AMP'+plane.upper()]*factor
+        df_lin['ERRAMP'+plane.upper()] = df_lin['AMP'+plane.upper()]*error
+        tfs.write(os.path.join(calibrated_harmonic_output, lin), df_lin, save_index=False)
+    return prefix
 
-        av_cal = reject_outliers(av_cal)
-        av_cal_err = reject_outliers(av_cal_err)
 
-        av_cal_bpms.append(1) if np.isnan(np.mean(av_cal)) else av_cal_bpms.append(np.mean(av_cal)) 
-        av_cal_err_bpms.append(1) if np.isnan(np.mean(av_cal_err)) else av_cal_err_bpms.append(np.mean(av_cal_err)) 
+def apply_calibration(sdds_dir, calibrations, jobs=1):
+    """
+    Writes the lin files of synched_harmonic with calibrated amplitudes
+    to calibrated_harmonic. Each measurement run is read and written once
+    for all planes in calibrations, jobs runs at the same time.
+    """
+    from concurrent.futures import ThreadPoolExecutor
 
-    
-    df_calibration = pandas.DataFrame(zip(all_bpms, av_cal_bpms, av_cal_err_bpms), columns=['NAME', 'CALIBRATION', 'ERROR_CALIBRATION'])
-    
-    tfs.write(options.sdds + '../calibration_'+options.plane+'.tfs', df_calibration, save_index=False)
+    synched_harmonic_output = os.path.join(sdds_dir[:-13], 'synched_harmonic')
+    calibrated_harmonic_output = os.path.join(sdds_dir[:-13], 'calibrated_harmonic')
 
     if not os.path.exists(calibrated_harmonic_output):
-        os.system('mkdir ' + calibrated_harmonic_output)
-    else: pass
+        os.makedirs(calibrated_harmonic_output)
 
     if os.path.exists(synched_harmonic_output) == False:
         print(" ********************************************\n",
                 "There is no synched_harmonic for calibration..\n",
                 " I stop now.\n",
                 "********************************************")
-        sys.exit()
-    else: pass
+        return
 
-
-    lins = [lin for lin in os.listdir(synched_harmonic_output) if 'lin'+options.plane in lin]
-    for lin in lins:
-        df_lin = tfs.read(os.path.join(synched_harmonic_output, lin))
-        df_lin['AMP'+options.plane.upper()] = df_lin['AMP'+options.plane.upper()]*df_calibration['CALIBRATION']
-        df_lin['ERRAMP'+options.plane.upper()] = df_lin['AMP'+options.plane.upper()]*df_calibration['ERROR_CALIBRATION']
-        tfs.write(os.path.join(calibrated_harmonic_output, lin), df_lin, save_index=False)
+    # run.sdds.linx (omc3) or run.sdds_linx (BetaBeat.src) -> run.sdds.
+    prefixes = sorted(set(lin[:-len('linx')] for lin in os.listdir(synched_harmonic_output)
+                          if any(lin.endswith('lin' + plane) for plane in calibrations)))
+    tasks = [(prefix, synched_harmonic_output, calibrated_harmonic_output, calibrations) for prefix in prefixes]
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        list(executor.map(calibrate_run, tasks))
 
     print(" ********************************************\n",
             "BPM calibration finished.\n",
             "Lin files are stored in " +calibrated_harmonic_output+ "\n",
             "********************************************")
+
+
+def check_calibration(sdds_dir, planes=('x', 'y'), jobs=1):
+    """
+    Estimates the BPM calibration of each plane in planes and applies
+    it to the lin files, with jobs threads.
+    """
+    calibrations = dict((plane, estimate_calibration(sdds_dir, plane)) for plane in planes)
+    apply_calibration(sdds_dir, calibrations, jobs)
+
+
+if __name__ == "__main__":
+    
+    parser = OptionParser()
+    parser.add_option("-s", "--sdds",  dest="sdds", help="Folder of sdds files, leades to other folders.", action="store")
+    parser.add_option("-p", "--plane",  dest="plane", help="Transverse plane, either x or y, comma separated for both.", action="store", default='x,y')
+    parser.add_option("-r", "--ring",  dest="ring", help="Ring ID, HER or LER", action="store")
+    parser.add_option("-j", "--jobs",  dest="jobs", help="Number of lin files processed at the same time.", action="store", type=int, default=1)
+    (options, args) = parser.parse_args()
+
+    check_calibration(options.sdds, options.plane.split(','), options.jobs)
@@ -1,40 +1,122 @@
 """
 Script to cut too long sdds file into smaller one by reducing turn number.
+All turn windows are written in a single pass over the file, so that only
+one line of the (large) sdds file is held in memory. If a float64 binary
+store of the file exists (see func.sdds_to_tbt), the windows are sliced
+from it instead of parsing the ASCII orbit lines.
 
 """
 
 from __future__ import print_function
 from optparse import OptionParser
-import numpy as np 
-import sys
 import os
+import numpy as np
+from func import tbt_is_fresh, tbt_path
 
 
-parser = OptionParser()
-parser.add_option("-f", "--file",  dest="file", help="Path to ASCII SKEKB SDDS file.", action="store")
-parser.add_option("-o", "--output",  dest="output", help="Path folder where the cut file will be stored.", action="store")
-parser.add_option("-s", "--start",  dest="start", help="Start turn number of smaller SDDS file.", action="store", type=int)
-parser.add_option("-e", "--end",  dest="end", help="End turn number of smaller SDDS file.", action="store", type=int)
-(options, args) = parser.parse_args()
-
-
-with open(options.file) as fo:
-    lines = fo.readlines()
-fo.close()
-header = [lin for lin in lines if '#' in lin]
-header.insert(4, '# cut set from turns: \t '+str(options.start)+' \t '+str(options.end)+' \n' )
-header.insert(11, '# - SDDS cutter written by Jacqueline Keintzel (27/11/2019) \n')
-orbits = [lin for lin in lines if not '#' in lin]
-end = (len(orbits[0].split()))-5 if options.end > len(orbits[0].split()) else options.end 
-cut = [(orbits[i].split()[:3] + orbits[i].split()[options.start+3 : end+3] + ['0', '0', '\n'] ) for i in range(len(orbits))]
-
-cut_file_name = options.file[-28:-5]+'_cut_'+str(options.start)+'_'+str(options.end)+'.sdds'
-fc = open(os.path.join(options.output, cut_file_name), 'w')
-for i in header: fc.write(str(i))
-for i in cut: 
-    for j, n in enumerate(i): 
-        if j == 0: fc.write(str(n)+' ')
-        elif j != len(i)-1: fc.write(str(n)+'\t\t')
-        else: fc.write(str(n))
-
-fc.close()
+def turn_windows(nturns, window, overlap=0):
+    """
+    Returns the (start, end) turns of all windows of length window
+    which fit into nturns, consecutive windows overlapping by overlap turns.
+    """
+    step = window - overlap
+    if step < 1:
+        raise ValueError('The overlap has to be smaller than the window.')
+    windows = [(start, start + window) for start in range(0, nturns - window + 1, step)]
+    if not windows:
+        windows = [(0, nturns)]
+    return windows
+
+
+def open_windows(sdds, output, header, windows):
+    """
+    Opens one cut file per turn window and writes its header.
+    Returns the names and the open files.
+    """
+    name = os.path.basename(sdds)[:-5]
+    cut_files = [name + '_cut_' + str(start) + '_' + str(end) + '.sdds' for start, end in windows]
+    fcs = [open(os.path.join(output, cut_file), 'w') for cut_file in cut_files]
+    for (start, end), fc in zip(windows, fcs):
+        cut_header = header[:]
+        cut_header.insert(4, '# cut set from turns: \t '+str(start)+' \t '+str(end)+' \n' )
+        cut_header.insert(11, '# - SDDS cutter written by Jacqueline Keintzel (27/11/2019) \n')
+        fc.writelines(cut_header)
+    return cut_files, fcs
+
+
+def cut_tbt(sdds, output, window=5000, overlap=0):
+    """
+    Same as cut_sdds, but slices the turn windows from the
+    memory-mapped binary store of sdds.
+    """
+    with open(sdds) as fo:
+        header = []
+        line = fo.readline()
+        while line.startswith('#'):
+            header.append(line)
+            line = fo.readline()
+
+    data = {'0': np.load(os.path.join(tbt_path(sdds), 'x.npy'), mmap_mode='r'),
+            '1': np.load(os.path.join(tbt_path(sdds), 'y.npy'), mmap_mode='r')}
+    windows = turn_windows(data['0'].shape[1], window, overlap)
+    cut_files, fcs = open_windows(sdds, output, header, windows)
+
+    row = {'0': 0, '1': 0}
+    with open(os.path.join(tbt_path(sdds), 'index.txt')) as fi:
+        for line in fi:
+            plane, bpm, s = line.split()
+            orbit = data[plane][row[plane]]
+            row[plane] += 1
+            for (start, end), fc in zip(windows, fcs):
+                fc.write(plane + ' ' + '\t\t'.join([bpm, s] + [repr(val) for val in orbit[start:end].tolist()] + ['0', '0']) + '\t\t\n')
+
+    for fc in fcs:
+        fc.close()
+    return cut_files
+
+
+def cut_sdds(sdds, output, window=5000, overlap=0):
+    """
+    Cuts sdds into files of window turns each, stored in output.
+    Each orbit line is read and split once and written to all
+    windows at the same time. Returns the names of the cut files.
+    """
+    if tbt_is_fresh(sdds):
+        if np.load(os.path.join(tbt_path(sdds), 'x.npy'), mmap_mode='r').dtype == np.float64:
+            return cut_tbt(sdds, output, window, overlap)
+
+    with open(sdds) as fo:
+        header = []
+        line = fo.readline()
+        while line.startswith('#'):
+            header.append(line)
+            line = fo.readline()
+        if not line:
+            return []
+
+        windows = turn_windows(len(line.split()) - 3, window, overlap)
+        cut_files, fcs = open_windows(sdds, output, header, windows)
+
+        while line:
+            fields = line.split()
+            if fields:
+                for (start, end), fc in zip(windows, fcs):
+                    fc.write(fields[0] + ' ' + '\t\t'.join(fields[1:3] + fields[start+3:end+3] + ['0', '0']) + '\t\t\n')
+            line = fo.readline()
+
+    for fc in fcs:
+        fc.close()
+    return cut_files
+
+
+if __name__ == "__main__":
+
+    parser = OptionParser()
+    parser.add_option("-f", "--file",  dest="file", help="Path to ASCII SKEKB SDDS file.", action="store")
+    parser.add_option("-o", "--output",  dest="output", help="Path folder where the cut files will be stored.", action="store")
+    parser.add_option("-w", "--window",  dest="window", help="Number of turns per cut file.", action="store", type=int, default=5000)
+    parser.add_option("-l", "--overlap",  dest="overlap", help="Number of turns shared by consecutive cut files.", action="store", type=int, default=0)
+    (options, args) = parser.parse_args()
+
+    for cut_file in cut_sdds(options.file, options.output, options.window, options.overlap):
+        print(cut_file)
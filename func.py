@@ -6,6 +6,10 @@ import os
 import re
 import numpy as np
 import sys
+import hashlib
+import mmap
+import shutil
+import tempfile
 from subprocess import Popen
 import time
 from datetime import datetime
@@ -56,12 +60,25 @@ def generic_dict(input_data_dir, file_dict, ringID):
         if file.endswith('.data') and file.startswith(ringID.upper()):
             files.append(file)
     
+    write_dict(file_dict, generic_pairs(input_data_dir, files))
+
+
+def generic_pairs(input_data_dir, files):
+    """
+    Returns the (data file, sdds name) pairs for the data files
+    in input_data_dir, named as in generic_dict.
+    """
+    return [(os.path.join(input_data_dir, file), file[:-5] + '.sdds') for file in files]
+
+
+def write_dict(file_dict, pairs):
+    """
+    Writes the (data file, sdds name) pairs to file_dict.
+    """
     fd = open(file_dict, 'w')
     fd.write('{\n')
-    for i, file in enumerate(files):
-        before = os.path.join(input_data_dir, file)
-        after = file[:-5] + '.sdds'
-        if files[i] != files[-1]:
+    for i, (before, after) in enumerate(pairs):
+        if i != len(pairs) - 1:
             fd.write('    {"' + before + '", "' + after + '"},\n')
         else:
             fd.write('    {"' + before + '", "' + after + '"}\n')
@@ -69,6 +86,32 @@ def generic_dict(input_data_dir, file_dict, ringID):
     fd.close()
 
 
+def new_data_files(input_data_dir, file_dict, ringID):
+    """
+    Returns the data files of the ring in input_data_dir
+    which are not yet in file_dict.
+    """
+    known = [os.path.normpath(data) for data, sdds in read_dict(file_dict)]
+    return sorted([file for file in os.listdir(input_data_dir)
+                   if file.endswith('.data') and file.startswith(ringID.upper())
+                   and os.path.normpath(os.path.join(input_data_dir, file)) not in known])
+
+
+def extend_dict(input_data_dir, file_dict, files):
+    """
+    Adds the data files to file_dict, named as in generic_dict.
+    """
+    write_dict(file_dict, read_dict(file_dict) + generic_pairs(input_data_dir, files))
+
+
+def read_dict(file_dict):
+    """
+    Returns the (data file, sdds name) pairs of a file_dict.txt file.
+    """
+    with open(file_dict) as f:
+        return re.findall(r'\{\s*"([^"]+)"\s*,\s*"([^"]+)"\s*\}', f.read())
+
+
 def check_path(path):
     """
     Check if path exists and is empty.
@@ -83,44 +126,329 @@ def check_path(path):
         return False
 
 
+def list_sdds(sdds_path):
+    """
+    Returns the names of all sdds files in sdds_path, without
+    the files and folders written next to them (e.g. <file>.sdds.tbt).
+    """
+    return [ff for ff in os.listdir(sdds_path) if ff.endswith('.sdds')]
+
+
+def pyplot(backend='Agg'):
+    """
+    Imports and returns matplotlib.pyplot. Plots are only written to
+    files, hence the non-interactive Agg backend is selected unless
+    another backend (None for the matplotlib default) is asked for.
+    """
+    import matplotlib
+    if backend is not None:
+        matplotlib.use(backend)
+    import matplotlib.pyplot as plt
+    return plt
+
+
+def map_jobs(function, tasks, jobs=1):
+    """
+    Returns [function(task) for task in tasks], computed by a pool of
+    jobs processes if jobs > 1. The results keep the order of tasks.
+    function has to be defined at module level to be sent to the pool.
+    """
+    if jobs > 1 and len(tasks) > 1:
+        from multiprocessing import Pool
+        pool = Pool(min(jobs, len(tasks)))
+        try:
+            return pool.map(function, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    return [function(task) for task in tasks]
+
+
+def run_commands(commands, names, jobs, log_dir):
+    """
+    Runs the given commands (argument lists) with at most jobs processes
+    at the same time. Output of each command is written to
+    log_dir/<name>.log. Returns a dictionary with the exit status of
+    each command, with the names as keys.
+    """
+    if not os.path.exists(log_dir):
+        os.makedirs(log_dir)
+
+    pending = list(zip(names, commands))
+    running = {}
+    status = {}
+    while pending or running:
+        while pending and len(running) < jobs:
+            name, command = pending.pop(0)
+            log = open(os.path.join(log_dir, str(name) + '.log'), 'w')
+            running[name] = (Popen(command, stdout=log, stderr=log), log)
+        for name in list(running):
+            p, log = running[name]
+            if p.poll() is not None:
+                log.close()
+                status[name] = p.returncode
+                del running[name]
+                print('Finished ' + str(name) + ' (exit status ' + str(p.returncode) + '), ' +
+                      str(len(status)) + '/' + str(len(names)) + ' done.')
+        time.sleep(0.2)
+    return status
+
+
+def log_path(output_path):
+    """
+    Returns the folder for the per-file logs of an output directory.
+    It is placed next to the output directory, so that folders listing
+    the measurement runs are not changed.
+    """
+    return os.path.normpath(output_path) + '_logs'
+
+
+def print_status(func_name, status):
+    """
+    Prints a summary of the exit status collected for each file.
+    """
+    failed = sorted([name for name in status if status[name] != 0])
+    print(" ********************************************\n",
+          func_name + ' summary:\n',
+          '"' + str(len(status) - len(failed)) + '/' + str(len(status)) + ' files finished successfully."\n',
+          "********************************************")
+    for name in failed:
+        print('Failed: ' + str(name) + ' (exit status ' + str(status[name]) + ')')
+
+
+def stop_on_existing(func_name, reason):
+    """
+    Stops the analysis, used with on_existing='fail'.
+    """
+    print(" ********************************************\n",
+          func_name + ':\n',
+          '"' + reason + ' I stop now (on_existing = fail)."\n',
+          "********************************************")
+    sys.exit(1)
+
+
+def write_conv_script(fn, lattice, LINE, runs, sdds_dir, fbpm_dir=None, consensus=False):
+    """
+    Writes a SAD script which converts the (data file, sdds name) pairs
+    in runs. With fbpm_dir the out of phase BPMs of each run are read
+    from fbpm_dir/<sdds name>.txt, with consensus all runs use
+    fbpm_dir/consensus.txt.
+    """
+    file = open(fn, "w")
+    file.write(#'FFS;\n'
+            #    'GetMAIN["' + lattice + '"];\n'
+               'read "' + lattice + '" ;\n'
+               '\n'
+               'FFS USE ' + LINE + ';\n'
+               'CELL; CALC;\n'
+               'emit;\n'
+            #    'em=Emittance[];\n'    
+               'Get["func.n"];\n\n'
+               'runs = {' + ', '.join(['{"' + data + '", "' + sdds + '"}' for data, sdds in runs]) + '};\n'
+               'Do[\n'
+               '    fnr1 = "./"//runs[i, 1];\n')
+    if fbpm_dir is None:
+        file.write('    fbpm = "None";\n')
+    elif consensus:
+        file.write('    fbpm = "' + outofphase_file(fbpm_dir, None, consensus) + '";\n')
+    else:
+        file.write('    fbpm = "' + fbpm_dir + '"//runs[i, 2]//".txt";\n')
+    file.write('    fwt1 = "' + sdds_dir + '"//runs[i, 2];\n'
+               '    Print["Converting "//runs[i, 1]//" -> "//runs[i, 2]];\n'
+               '    FormatBPMRead[fnr1, fwt1, fbpm];\n'
+               '    ,{i, 1, Length[runs]}];\n'
+               '\n'
+               'abort;\n')
+    file.close()
+
+
+def outofphase_file(fbpm_dir, sdds, consensus=False):
+    """
+    Returns the file with the out of phase BPMs used to convert sdds:
+    the one of this run or, with consensus, the one shared by all runs.
+    """
+    return os.path.join(fbpm_dir, 'consensus.txt' if consensus else os.path.basename(sdds) + '.txt')
+
+
+def conversion_sources(data, sdds, fbpm_dir=None, consensus=False):
+    """
+    Returns the files an sdds file is converted from: its .data file
+    and, with fbpm_dir, its outofphase file.
+    """
+    sources = [data]
+    if fbpm_dir is not None:
+        sources.append(outofphase_file(fbpm_dir, sdds, consensus))
+    return sources
+
+
+def conversion_outdated(data, sdds, fbpm_dir=None, consensus=False):
+    """
+    True if the sdds file is missing or older than one of its
+    conversion_sources.
+    """
+    if not os.path.isfile(sdds):
+        return True
+    return any(os.path.getmtime(ff) > os.path.getmtime(sdds)
+               for ff in conversion_sources(data, sdds, fbpm_dir, consensus) if os.path.isfile(ff))
+
+
+def import_omc3(omc3_path):
+    """
+    Imports omc3 from omc3_path (the omc3 package folder, as given in
+    parameters.txt) and returns the hole_in_one entry point.
+    """
+    omc3_parent = os.path.dirname(os.path.normpath(omc3_path))
+    if omc3_parent not in sys.path:
+        sys.path.insert(0, omc3_parent)
+    from omc3.hole_in_one import hole_in_one_entrypoint
+    return hole_in_one_entrypoint
+
+
+_hole_in_one = None
+
+
+def omc3_worker(omc3_path):
+    """
+    Initialises a process of the omc3 pool, which imports omc3 only once.
+    """
+    global _hole_in_one
+    _hole_in_one = import_omc3(omc3_path)
+
+
+def omc3_task(task):
+    """
+    Runs hole_in_one with the arguments of one command in a process of the
+    omc3 pool. The output is written to the log file of the task.
+    """
+    name, arguments, log_file = task
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved = os.dup(1), os.dup(2)
+    with open(log_file, 'w') as log:
+        os.dup2(log.fileno(), 1)
+        os.dup2(log.fileno(), 2)
+        try:
+            _hole_in_one(arguments)
+            returncode = 0
+        except (Exception, SystemExit):
+            import traceback
+            traceback.print_exc()
+            returncode = 1
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os.dup2(saved[0], 1)
+            os.dup2(saved[1], 2)
+            os.close(saved[0])
+            os.close(saved[1])
+    return name, returncode
+
+
+def run_omc3(commands, names, jobs, log_dir, omc3_path):
+    """
+    Same as run_commands for commands [python, hole_in_one.py, arguments..]
+    of omc3, but the analyses run in this process (jobs = 1) or in a pool of jobs
+    processes which import omc3 once, instead of one python per command.
+    """
+    arguments = [command[2:] for command in commands]
+    status = {}
+    if jobs > 1:
+        from multiprocessing import Pool
+        if not os.path.exists(log_dir):
+            os.makedirs(log_dir)
+        tasks = [(name, args, os.path.join(log_dir, str(name) + '.log')) for name, args in zip(names, arguments)]
+        pool = Pool(jobs, omc3_worker, (omc3_path,))
+        for name, returncode in pool.imap_unordered(omc3_task, tasks):
+            status[name] = returncode
+            print('Finished ' + str(name) + ' (exit status ' + str(returncode) + '), ' +
+                  str(len(status)) + '/' + str(len(names)) + ' done.')
+        pool.close()
+        pool.join()
+        return status
+
+    hole_in_one = import_omc3(omc3_path)
+    for i, (name, args) in enumerate(zip(names, arguments)):
+        print('Working on file ' + str(i+1) + '/' + str(len(names)) + ': ' + str(name))
+        try:
+            hole_in_one(args)
+            status[name] = 0
+        except (Exception, SystemExit) as err:
+            print('Failed: ' + str(name) + ': ' + repr(err))
+            status[name] = 1
+    return status
+
+
 def sdds_conv(input_data_dir, file_dict, main_output_dir, sdds_dir,
-              lattice, gsad, ringID, kickax, asynch_info):
+              lattice, gsad, ringID, kickax, asynch_info, on_existing=None, jobs=1, consensus=False, files=None):
     """
     KEK datafile -> sdds conversion.
     Function generates a SAD script which does the conversion, and then calls it.
+    on_existing decides without asking what happens if sdds_dir contains
+    files: 'reuse' keeps them, 'clean' removes them and converts again,
+    'update' converts only the files which are missing or older than their
+    .data file (or, with asynch_info, their outofphase file),
+    'fail' stops. A missing file_dict is then created from the input data
+    ('fail' stops). With None the user is asked.
+    With jobs > 1 the files are split over up to jobs SAD sessions
+    running at the same time, each with its own script and log file.
+    With consensus and asynch_info all files are converted with the
+    offsets of outofphase<kickax>/consensus.txt (see checkAsync.py).
+    With files only these sdds names of file_dict are converted, whatever
+    sdds_dir contains: the caller has already decided they are out of
+    date (run_SOMA.py passes the stale units of its pipeline).
     """
-    def do_stuff():
+    def do_stuff(runs=None):
+        if runs is None:
+            runs = read_dict(file_dict)
         if asynch_info == False:
-            fn = 'prerun.sad'
+            fn = 'prerun'
+            fbpm_dir = None
         else:
-            fn = 'run.sad'
+            fn = 'run'
+            fbpm_dir = main_output_dir + 'outofphase' + kickax.lower() + '/'
         LINE = get_LINE(lattice, gsad)
-        file = open(fn, "w")
-        file.write(#'FFS;\n'
-                #    'GetMAIN["' + lattice + '"];\n'
-                   'read "' + lattice + '" ;\n'
-                   '\n'
-                   'FFS USE ' + LINE + ';\n'
-                   'CELL; CALC;\n'
-                   'emit;\n'
-                #    'em=Emittance[];\n'    
-                   'Get["func.n"];\n\n'
-                   'runs = Get["' + file_dict + '"];\n'
-                   'Do[\n'
-                   '    fnr1 = "./"//runs[i, 1];\n')
-        if asynch_info == False:
-            file.write('    fbpm = "None";\n')
-        elif asynch_info == True:
-            file.write('    fbpm = "' + main_output_dir + 'outofphase' + kickax.lower() + '/"//runs[i, 2]//".txt";\n')
-        file.write('    fwt1 = "' + sdds_dir + '"//runs[i, 2];\n'
-                   '    Print["Converting "//runs[i, 1]//" -> "//runs[i, 2]];\n'
-                   '    FormatBPMRead[fnr1, fwt1, fbpm];\n'
-                   '    ,{i, 1, Length[runs]}];\n'
-                   '\n'
-                   'abort;\n')
-        file.close()
-
-        os.system(gsad + " " + fn)
+
+        # uniquely named scripts in a folder of this call, so that conversions
+        # running at the same time do not overwrite each other's scripts
+        scratch = tempfile.mkdtemp(prefix='sdds_conv_')
+        nchunks = max(1, min(jobs, len(runs)))
+        chunks = {}
+        for k in range(nchunks):
+            fd, fnk = tempfile.mkstemp(prefix=fn + '_', suffix='.sad', dir=scratch)
+            os.close(fd)
+            chunks[fnk] = runs[k::nchunks]
+            write_conv_script(fnk, lattice, LINE, chunks[fnk], sdds_dir, fbpm_dir, consensus)
+        try:
+            if nchunks > 1:
+                names = sorted(chunks)
+                commands = [gsad.split() + [fnk] for fnk in names]
+                print('Converting ' + str(len(runs)) + ' files with ' + str(nchunks) + ' SAD sessions, logs are written to ' + log_path(sdds_dir))
+                chunk_status = run_commands(commands, [os.path.basename(fnk) for fnk in names], jobs, log_path(sdds_dir))
+                status = dict((sdds, chunk_status[os.path.basename(fnk)]) for fnk in chunks for data, sdds in chunks[fnk])
+            else:
+                returncode = os.system(gsad + " " + list(chunks)[0])
+                status = dict((sdds, returncode) for data, sdds in runs)
+        finally:
+            shutil.rmtree(scratch)
+        fn = fn + ' conversion (' + str(nchunks) + ' SAD session' + ('s' if nchunks > 1 else '') + ')'
+
+        # SAD ends with abort, so its exit status says nothing about single files:
+        # a file is only converted successfully if it has been written, is not
+        # empty and is not older than its .data file
+        missing = []
+        for data, sdds in runs:
+            sdds_file = os.path.join(sdds_dir, sdds)
+            if (not os.path.isfile(sdds_file) or os.path.getsize(sdds_file) == 0 or
+                    (os.path.isfile(data) and os.path.getmtime(sdds_file) < os.path.getmtime(data))):
+                missing.append(sdds)
+                if os.path.isfile(sdds_file) and os.path.getsize(sdds_file) == 0:
+                    # removed, so that the file counts as not converted next time
+                    os.remove(sdds_file)
+                if status[sdds] == 0:
+                    status[sdds] = 1
+        print_status('sdds_conv', status)
+        if missing:
+            print('Not converted (sdds file missing, empty or older than its .data file): ' + ', '.join(missing))
         return print(" ********************************************\n",
                      "sdds_conv:\n",
                      '"' + fn + ' finished, sdds files can be found in ' + sdds_dir + '."\n',
@@ -128,6 +456,11 @@ def sdds_conv(input_data_dir, file_dict, main_output_dir, sdds_dir,
     while True:
         if look_for_dict(file_dict) == True:
             break
+        elif on_existing == 'fail':
+            stop_on_existing('sdds_conv', 'There is no dictionary file ' + file_dict + '.')
+        elif on_existing is not None:
+            generic_dict(input_data_dir, file_dict, ringID)
+            continue
         else:
             user_input = input('There is no dictionary file present for .data -> .sdds conversion. Would you like to create a new one (input -> create (\'create\' in python 2)) or would you like to provide one (input -> provide (\'provide\' in pyhton 2))?\n')
             if user_input == 'create':
@@ -135,9 +468,38 @@ def sdds_conv(input_data_dir, file_dict, main_output_dir, sdds_dir,
                 continue
             elif user_input == 'provide':
                 continue
+    if files is not None:
+        if not os.path.exists(sdds_dir):
+            os.makedirs(sdds_dir)
+        runs = [(data, sdds) for data, sdds in read_dict(file_dict) if sdds in files]
+        if runs:
+            do_stuff(runs)
+        return
     if os.path.exists(sdds_dir):
         # Checking if it is empty
         if os.listdir(sdds_dir):
+            if on_existing == 'reuse':
+                return print(" ********************************************\n",
+                             "sdds_conv:\n",
+                             '"Reusing the files in ' + sdds_dir + ', nothing is converted."\n',
+                             "********************************************")
+            elif on_existing == 'clean':
+                os.system('rm -r ' + sdds_dir + '*')
+                do_stuff()
+                return
+            elif on_existing == 'update':
+                fbpm_dir = main_output_dir + 'outofphase' + kickax.lower() + '/' if asynch_info else None
+                runs = [(data, sdds) for data, sdds in read_dict(file_dict)
+                        if conversion_outdated(data, os.path.join(sdds_dir, sdds), fbpm_dir, consensus)]
+                if runs:
+                    do_stuff(runs)
+                    return
+                return print(" ********************************************\n",
+                             "sdds_conv:\n",
+                             '"All sdds files in ' + sdds_dir + ' are up to date, nothing is converted."\n',
+                             "********************************************")
+            elif on_existing == 'fail':
+                stop_on_existing('sdds_conv', sdds_dir + ' directory contains files.')
             while True:
                 user_input = input(sdds_dir + ' directory contains files. Would you like to clean the directory and start from scratch? (options: yes, no, show contents (python 3) or \'yes\', \'no\', \'show contents\' (python 2)\n')
                 if user_input == 'yes':
@@ -159,23 +521,23 @@ def sdds_conv(input_data_dir, file_dict, main_output_dir, sdds_dir,
         do_stuff()
 
 
-def cut_large_sdds(python_exe, sdds_path):
-    all_sdds = [ss for ss in os.listdir(sdds_path) if '.sdds' in ss and not 'cut' in ss]
+def cut_large_sdds(sdds_path, window=5000, overlap=0, min_size=1e8):
+    """
+    Cuts all sdds files larger than min_size bytes (i.e. 50k turns) into
+    files of window turns, see cutSDDS.py. Files which have been cut
+    after their last change are skipped.
+    """
+    from cutSDDS import cut_sdds
+    all_sdds = [ss for ss in list_sdds(sdds_path) if not 'cut' in ss]
     sizes = [float(os.path.getsize(os.path.join(sdds_path, ss))) for ss in all_sdds ]
-    turns50k = [i for i in range(len(sizes)) if sizes[i]>1e8 ]
-    files50k = [all_sdds[i] for i in turns50k]
-
-    starts = np.arange(0, 50000, 5000)
-    ends = np.arange(5000, 55000, 5000)
+    files50k = [all_sdds[i] for i in range(len(sizes)) if sizes[i]>min_size ]
 
     for ff in files50k:
-        for start, end in zip(starts, ends):
-            os.system(str(python_exe)+ ' cutSDDS.py' +
-                        ' --file ' + os.path.join(sdds_path, ff) +
-                        ' --output ' + sdds_path +
-                        ' --start ' + str(start) +
-                        ' --end ' + str(end) )
-            
+        first_cut = os.path.join(sdds_path, ff[:-5] + '_cut_0_' + str(window) + '.sdds')
+        if os.path.isfile(first_cut) and os.path.getmtime(first_cut) >= os.path.getmtime(os.path.join(sdds_path, ff)):
+            continue
+        print('Cutting ' + ff + ' into files of ' + str(window) + ' turns.')
+        cut_sdds(os.path.join(sdds_path, ff), sdds_path, window, overlap)
 
 
 def get_LINE(lattice, gsad):
@@ -190,19 +552,73 @@ def get_LINE(lattice, gsad):
             return RINGNAME
 
 
-def makemodel_and_guesstune(model_path, lattice, gsad):
+def offmom_grid():
+    """
+    Returns the DP0 values of the off-momentum model scan.
+    """
+    return [round(dp0, 4) for dp0 in np.arange(-1e-3, 1.1e-3, 1e-4)]
+
+
+def write_offmom_script(fn, lattice, LINE, model_path, dp0s):
+    """
+    Writes a SAD script which reads the lattice once and saves
+    the twiss files for all given DP0 values.
+    """
+    scan = ',\n'.join(['    {"' + str(dp0) + '", '
+                       '"' + model_path + '/twiss_dp0_' + str(dp0) + '.dat", '
+                       '"' + model_path + '/twiss_elements_dp0_' + str(dp0) + '.dat"}' for dp0 in dp0s])
+    ff = open(fn, 'w')
+    ff.write(#'FFS;\n\n'
+            # 'GetMAIN["' + lattice + '"];\n'
+            'read "' + lattice + '" ;\n'
+            'FFS USE ' + LINE + ';\n'
+            'CELL;\n'
+            'Get["func.n"];\n\n'
+            'scan = {\n' + scan + '};\n\n'
+            'Do[\n'
+            '    FFS["DP0="//scan[k, 1]//"; CALC;"];\n'
+            '    em = Emittance[];\n'
+            '    Print["Saving twiss for DP0 = "//scan[k, 1]];\n'
+            '    SaveTwiss[scan[k, 2], scan[k, 3]];\n'
+            '    ,{k, 1, Length[scan]}];\n'
+            '\n'
+            'abort;\n')
+    ff.close()
+
+
+def makemodel_and_guesstune(model_path, lattice, gsad, scan_mode='session', jobs=1, on_existing=None, scratch_dir=None):
     """
     Function which creates a model for BetaBeat.src analysis and
     generates and executes SAD script to obtain initial guesses
     for x & y tunes.
+    The off-momentum twiss files are written by one SAD session
+    (scan_mode='session') or by up to jobs SAD sessions at the same time
+    (scan_mode='parallel').
+    If model_path already contains files, on_existing decides without
+    asking: 'reuse' keeps the model, 'clean' creates it again (files of
+    the model are overwritten, other files are kept), 'update' creates
+    it again only if twiss.dat is older than the lattice, 'fail' stops.
+    With None the user is asked.
+    The SAD scripts are written to a new folder in scratch_dir (the
+    temporary folder of the system by default), the tune guesses to
+    tune_guess.txt in model_path.
     """
-    LINE = get_LINE(lattice, gsad)
     if not os.path.exists(model_path):
         os.system('mkdir ' + model_path)
     else:
         pass
 
-    if len(os.listdir(model_path)) > 2:
+    if on_existing == 'update':
+        twiss = os.path.join(model_path, 'twiss.dat')
+        uptodate = os.path.isfile(twiss) and os.path.getmtime(twiss) >= os.path.getmtime(lattice)
+        on_existing = 'reuse' if uptodate else 'clean'
+
+    if len(os.listdir(model_path)) > 2 and on_existing == 'reuse':
+        print('Reusing the model in ' + model_path + ', no model is created.')
+        return
+    elif len(os.listdir(model_path)) > 2 and on_existing == 'fail':
+        stop_on_existing('makemodel_and_guesstune', model_path + ' directory contains files.')
+    elif len(os.listdir(model_path)) > 2 and on_existing is None:
         print('\nThe following files have been found in the model directory:')
         print(os.listdir(model_path),'\n')
         while True:
@@ -216,6 +632,7 @@ def makemodel_and_guesstune(model_path, lattice, gsad):
                 print('Please enter a valid input ("y" or "n").')
                 continue
     
+    LINE = get_LINE(lattice, gsad)
     fn = model_path+'/error_deffs.txt'
     file = open(fn, "w")
     file.write(
@@ -234,7 +651,26 @@ def makemodel_and_guesstune(model_path, lattice, gsad):
     file.close()
 
 
-    fn = 'model_and_tune.sad'
+    # the SAD scripts are written to a folder of this call and removed afterwards
+    scratch = tempfile.mkdtemp(prefix='model_', dir=scratch_dir)
+    try:
+        make_model(model_path, lattice, LINE, gsad, scratch, scan_mode, jobs)
+    finally:
+        shutil.rmtree(scratch)
+
+    return print(" ********************************************\n",
+                 "makemodel_and_guesstunes:\n",
+                 '"Model is ready in ' + model_path + ' and tune guesses are written to ' + os.path.join(model_path, 'tune_guess.txt') + '."\n',
+                 "********************************************")
+
+
+def make_model(model_path, lattice, LINE, gsad, scratch, scan_mode='session', jobs=1):
+    """
+    Runs the SAD scripts of makemodel_and_guesstune, written to scratch:
+    twiss.dat, twiss_elements.dat and tune_guess.txt, then the
+    off-momentum twiss files in one or up to jobs SAD sessions.
+    """
+    fn = os.path.join(scratch, 'model_and_tune.sad')
     file = open(fn, "w")
     file.write(#'FFS;\n\n'
             #    'GetMAIN["' + lattice + '"];\n'
@@ -248,7 +684,7 @@ def makemodel_and_guesstune(model_path, lattice, gsad):
                'fn1 = "' + model_path + '/twiss.dat";\n'
                'fn2 = "' + model_path + '/twiss_elements.dat";\n'
                'SaveTwiss[fn1, fn2];\n\n'
-               'file = OpenWrite["tune_guess.txt"];\n'
+               'file = OpenWrite["' + model_path + '/tune_guess.txt"];\n'
                'WriteString[file, "Qx = ", Twiss["nx", $$$]/(2*Pi), "\\n"];\n'
                'WriteString[file, "Qy = ", Twiss["ny", $$$]/(2*Pi), "\\n"];\n'
                'Close[file];\n'
@@ -258,39 +694,121 @@ def makemodel_and_guesstune(model_path, lattice, gsad):
     os.system(gsad + ' ' + fn)
 
     # create several twiss files to then compute second order dispersion in plotting script 
-    for dp0 in np.arange(-1e-3, 1.1e-3, 1e-4):
-        # print(round(dp0,4))
-        fn = 'offmom_model.sad'
-        ff = open(fn,'w')
-        ff.write(#'FFS;\n\n'
-                # 'GetMAIN["' + lattice + '"];\n'
-                'read "' + lattice + '" ;\n'
-                'FFS USE ' + LINE + ';\n'
-                'CELL;\n'
-                'DP0='+str(round(dp0,4))+';\n'
-                'CALC;\n'
-                'em = Emittance[];\n\n'
-                'Get["func.n"];\n\n'
-                'fn1 = "' + model_path + '/twiss_dp0_'+str(round(dp0,4))+'.dat";\n'
-                'fn2 = "' + model_path + '/twiss_elements_dp0_'+str(round(dp0,4))+'.dat";\n'
-                'SaveTwiss[fn1, fn2];\n\n'
-                'abort;\n')
-        ff.close()
+    dp0s = offmom_grid()
+    if scan_mode == 'parallel':
+        # one script per worker, each worker scans its own share of the DP0 values
+        nchunks = max(1, min(jobs, len(dp0s)))
+        commands = []
+        names = []
+        for k in range(nchunks):
+            fn = os.path.join(scratch, 'offmom_model_' + str(k) + '.sad')
+            write_offmom_script(fn, lattice, LINE, model_path, dp0s[k::nchunks])
+            commands.append(gsad.split() + [fn])
+            names.append(os.path.basename(scratch) + '_' + str(k))
+        print_status('Off-momentum model', run_commands(commands, names, jobs, log_path(model_path)))
+    else:
+        fn = os.path.join(scratch, 'offmom_model.sad')
+        write_offmom_script(fn, lattice, LINE, model_path, dp0s)
         os.system(gsad + ' ' + fn)
 
+
+def write_tune_over_mom(model_path):
+    """
+    Writes the model tunes of the off-momentum twiss files
+    to tune_over_mom.txt in model_path.
+    """
+    all_twiss = [ii for ii in os.listdir(model_path) if ii.startswith('twiss_dp0_')]
+    fo = open(os.path.join(model_path, 'tune_over_mom.txt'),'w')
+    fo.write('DPP \t QX \t QY \n')
+    for tw in sorted(all_twiss, key=lambda tw: float(tw[10:-4])):
+        dpp = tw[10:-4]
+        with open(os.path.join(model_path, tw)) as ft:
+            header = [line.split() for line in ft if line.startswith('@')]
+        Qx = [line[3] for line in header if line[1] == 'Q1'][0]
+        Qy = [line[3] for line in header if line[1] == 'Q2'][0]
+        fo.write(dpp+'\t'+Qx+'\t'+Qy+'\n')
+    fo.close()
+
+
+def model_key(lattice, LINE, dp0s):
+    """
+    Returns the SHA1 of the lattice file, the LINE name and the
+    DP0 values of the off-momentum scan, used as model cache key.
+    """
+    sha = hashlib.sha1()
+    with open(lattice, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha.update(chunk)
+    sha.update(('\n' + LINE + '\n' + repr(dp0s)).encode())
+    return sha.hexdigest()
+
+
+def model_from_cache(model_path, lattice, gsad, cache_path, scan_mode='session', jobs=1):
+    """
+    Provides the model files (twiss.dat, twiss_elements.dat, the off-momentum
+    twiss files and tune_over_mom.txt) in model_path from a cache folder
+    keyed on lattice, LINE and off-momentum scan. On a miss, the model is
+    built with SAD into a fresh folder which is only moved into the
+    cache once it is complete.
+    """
+    LINE = get_LINE(lattice, gsad)
+    key = model_key(lattice, LINE, offmom_grid())
+    entry = os.path.join(cache_path, key)
+
+    if os.path.isdir(entry):
+        print(" ********************************************\n",
+              "model_from_cache:\n",
+              '"Model for ' + lattice + ' found in ' + entry + ', SAD is not started."\n',
+              "********************************************")
+    else:
+        if not os.path.exists(cache_path):
+            os.makedirs(cache_path)
+        build = tempfile.mkdtemp(prefix=key + '.', dir=cache_path)
+        # everything SAD writes stays in the build folder until it is complete
+        makemodel_and_guesstune(build + '/', lattice, gsad, scan_mode, jobs, scratch_dir=build)
+        if not os.path.isfile(os.path.join(build, 'twiss.dat')):
+            shutil.rmtree(build)
+            print(" ********************************************\n",
+                  "model_from_cache:\n",
+                  '"SAD did not write twiss.dat, no model is created.."\n',
+                  "********************************************")
+            return
+        write_tune_over_mom(build)
+        try:
+            os.rename(build, entry)
+        except OSError:
+            # the same model has been built in the meantime by another run
+            shutil.rmtree(build)
+
+    if not os.path.exists(model_path):
+        os.makedirs(model_path)
+    # copied with a new modification time, so that the model is not older than the lattice
+    for ff in os.listdir(entry):
+        shutil.copy(os.path.join(entry, ff), os.path.join(model_path, ff))
     return print(" ********************************************\n",
-                 "makemodel_and_guesstunes:\n",
-                 '"' + fn + ' finished, model is ready in ' + model_path + ' and tune guesses are written to tune_guess.txt."\n',
+                 "model_from_cache:\n",
+                 '"Model is ready in ' + model_path + '."\n',
                  "********************************************")
 
 
 def harmonic_analysis(py_version, python_exe, BetaBeatsrc_path, model_path,
                       harmonic_output_path, sdds_path, nturns,
-                      tune_range, lattice, gsad):
+                      tune_range, lattice, gsad, jobs=1, files=None, engine='harpy',
+                      inprocess=False, tbt=False):
     """
     Function to call hole_in_one.py script from BetaBeat.src or omc3.
+    With engine='numpy' the lin files are written by harmonicNumpy.py
+    instead, in this process or, with jobs > 1, in jobs processes. They
+    read the binary store of each sdds file if it is fresh, with tbt it is
+    written first.
+    With inprocess, omc3 is imported once and called directly (see run_omc3).
+    A model is only created when there is none in model_path yet.
+    With jobs > 1 up to jobs files are analysed at the same time and
+    the output of each file is written to a log file (see log_path).
+    Only the sdds files in files are analysed, if given.
     """
-    makemodel_and_guesstune(model_path, lattice, gsad)
+    if not os.path.isfile(os.path.join(model_path, 'twiss.dat')):
+        makemodel_and_guesstune(model_path, lattice, gsad, on_existing='clean')
     import math
     with open(os.path.join(model_path, 'twiss.dat')) as mdl:
         lines = mdl.readlines()
@@ -324,58 +842,58 @@ def harmonic_analysis(py_version, python_exe, BetaBeatsrc_path, model_path,
     if not os.path.exists(harmonic_output_path):
         os.system('mkdir ' + harmonic_output_path) 
 
-    sdds_files = [ff for ff in os.listdir(sdds_path) if '.sdds' in ff ]
+    sdds_files = list_sdds(sdds_path) if files is None else list(files)
     # print(sdds_files)
     # quit()
-    for i, run in enumerate(sdds_files):
-        start = time.time()
-        print(" ********************************************\n",
-              "harmonics analysis:\n",
-              '"Working on file ' + str(i+1) + '/' + str(len(sdds_files)) + ': ' + str(run) + '"\n',
-              "********************************************")
-        if py_version > 2:
-            # print(str(python_exe) +' '
-            #         +str(BetaBeatsrc_path) + 'hole_in_one.py'
-            #         ' --harpy'
-            #         ' --files ' + os.path.join(sdds_path, run) +
-            #         ' --outputdir ' + harmonic_output_path + 
-            #         ' --model '+ model_path + 'twiss.dat'
-            #         ' --tunes '+ drv_tunex + ' ' + drv_tuney + ' ' + tunez +
-            #         ' --nattunes ' + model_tunex + ' ' + model_tuney + ' ' + tunez+
-            #         ' --turns 0 ' + nturns +
-            #         ' --tolerance ' + tune_range +
-            #         ' --unit mm' # ("m", "cm", "mm", "um")
-            #         # ' --keep_exact_zeros'
-            #         # ' --to_write spectra bpm_summary lin full_spectra'
-            #         # ' --to_write lin full_spectra'
-            #         ' --to_write lin'
-            #         ' --clean'
-            #         ' --sing_val 20' 
-            #         ' --max_peak ' + max_peak +
-            #         ' --tune_clean_limit 1e-3'
-            # )
-
-            os.system(str(python_exe) +' '
-                    +str(BetaBeatsrc_path) + 'hole_in_one.py'
-                    ' --harpy'
-                    ' --files ' + os.path.join(sdds_path, run) +
-                    ' --outputdir ' + harmonic_output_path + 
-                    ' --model '+ model_path + 'twiss.dat'
-                    ' --tunes '+ drv_tunex + ' ' + drv_tuney + ' ' + tunez +
-                    ' --nattunes ' + model_tunex + ' ' + model_tuney + ' ' + tunez+
-                    ' --turns 0 ' + nturns +
-                    ' --tolerance ' + tune_range +
-                    ' --unit mm' # ("m", "cm", "mm", "um")
-                    # ' --keep_exact_zeros'
-                    # ' --to_write spectra bpm_summary lin full_spectra'
-                    # ' --to_write lin full_spectra'
-                    ' --to_write lin'
-                    # ' --clean'
-                    ' --sing_val 20' 
-                    ' --max_peak ' + max_peak +
-                    ' --tune_clean_limit 1e-3')        
+    if engine == 'numpy' and jobs == 1:
+        from harmonicNumpy import harmonic_numpy
+        status = {}
+        for i, run in enumerate(sdds_files):
+            print('Working on file ' + str(i+1) + '/' + str(len(sdds_files)) + ': ' + str(run))
+            try:
+                harmonic_numpy(os.path.join(sdds_path, run), harmonic_output_path,
+                               [float(drv_tunex), float(drv_tuney)], float(tune_range), int(nturns), tbt=tbt)
+                status[run] = 0
+            except Exception as err:
+                print('Failed: ' + str(run) + ': ' + str(err))
+                status[run] = 1
+        print_status('Harmonics analysis', status)
+        return print(" ********************************************\n",
+                     "Harmonics analysis finished.\n",
+                     "********************************************")
+
+    commands = []
+    for run in sdds_files:
+        if engine == 'numpy':
+            commands.append([sys.executable, 'harmonicNumpy.py',
+                    '--file', os.path.join(sdds_path, run),
+                    '--outputdir', harmonic_output_path,
+                    '--tunex', drv_tunex,
+                    '--tuney', drv_tuney,
+                    '--tolerance', tune_range,
+                    '--turns', nturns] + (['--tbt'] if tbt else []))
+        elif py_version > 2:
+            commands.append([python_exe,
+                    BetaBeatsrc_path + 'hole_in_one.py',
+                    '--harpy',
+                    '--files', os.path.join(sdds_path, run),
+                    '--outputdir', harmonic_output_path,
+                    '--model', model_path + 'twiss.dat',
+                    '--tunes', drv_tunex, drv_tuney, tunez,
+                    '--nattunes', model_tunex, model_tuney, tunez,
+                    '--turns', '0', nturns,
+                    '--tolerance', tune_range,
+                    '--unit', 'mm', # ("m", "cm", "mm", "um")
+                    # '--keep_exact_zeros',
+                    # '--to_write', 'spectra', 'bpm_summary', 'lin', 'full_spectra',
+                    # '--to_write', 'lin', 'full_spectra',
+                    '--to_write', 'lin',
+                    # '--clean',
+                    '--sing_val', '20',
+                    '--max_peak', max_peak,
+                    '--tune_clean_limit', '1e-3'])
         else:
-            p = Popen([python_exe,
+            commands.append([python_exe,
                     BetaBeatsrc_path + 'hole_in_one.py',
                     '--file', os.path.join(sdds_path, run),
                     '--outputdir', harmonic_output_path,
@@ -390,9 +908,27 @@ def harmonic_analysis(py_version, python_exe, BetaBeatsrc_path, model_path,
                     '--nattuney=' + model_tuney,
                     '--tolerance=' + tune_range,
                     '--tune_clean_limit=1e-4']) # changed from 1e-5 to 10e-5 so that fewer BPMs are cleaned
-            p.wait()
-        finish = time.time() - start
-        # timer('Harmonic analysis', i, len(sdds_files), finish)
+
+    if inprocess and py_version > 2 and engine != 'numpy':
+        status = run_omc3(commands, sdds_files, jobs, log_path(harmonic_output_path), BetaBeatsrc_path)
+    elif jobs > 1:
+        print(" ********************************************\n",
+              "harmonics analysis:\n",
+              '"Running ' + str(len(sdds_files)) + ' files on ' + str(jobs) + ' processes, logs are written to ' + log_path(harmonic_output_path) + '"\n',
+              "********************************************")
+        status = run_commands(commands, sdds_files, jobs, log_path(harmonic_output_path))
+    else:
+        status = {}
+        for i, run in enumerate(sdds_files):
+            start = time.time()
+            print(" ********************************************\n",
+                  "harmonics analysis:\n",
+                  '"Working on file ' + str(i+1) + '/' + str(len(sdds_files)) + ': ' + str(run) + '"\n',
+                  "********************************************")
+            status[run] = Popen(commands[i]).wait()
+            finish = time.time() - start
+            # timer('Harmonic analysis', i, len(sdds_files), finish)
+    print_status('Harmonics analysis', status)
     return print(" ********************************************\n",
                  "Harmonics analysis finished.\n",
                  "********************************************")
@@ -437,13 +973,20 @@ def harmonic_analysis(py_version, python_exe, BetaBeatsrc_path, model_path,
 
 def optics_analysis(py_version, python_exe, BetaBeatsrc_path, model_path,
                    harmonic_output_path, optics_output_path, sdds_path, 
-                   ringID, all_files_flag):
+                   ringID, all_files_flag, jobs=1, with_average=False, files=None,
+                   inprocess=False):
     """
     Function to trigger optics measurements from BetaBeat.src or omc3.
+    Each measurement is analysed into its own folder, up to jobs at the
+    same time. With with_average the all files analysis into average/ is
+    scheduled together with the single file analyses. If files is given,
+    only these are analysed into their own folder, the average is always
+    taken over all files. With inprocess, omc3 is imported once and
+    called directly (see run_omc3).
     """
     if not os.path.exists(optics_output_path):
         os.system('mkdir ' + optics_output_path)
-    sdds_files = [ff for ff in os.listdir(sdds_path) if '.sdds' in ff[-5:] ]
+    sdds_files = list_sdds(sdds_path)
     #sdds_files = [ff for ff in sdds_files if not 'cut' in ff]
 
     try:
@@ -459,48 +1002,12 @@ def optics_analysis(py_version, python_exe, BetaBeatsrc_path, model_path,
           "Optics analysis starts\n",
           "*******************************************")
 
-    if all_files_flag == True:
-        allff = str()
-        if py_version > 2:
-            for ff in sdds_files:
-                allff = allff + os.path.join(harmonic_output_path,ff) + ' '
-        else:
-            for ff in sdds_files:
-                allff = allff + os.path.join(harmonic_output_path,ff) + ','
-        allff = allff[:-1]
-      
-        if py_version > 2:
-            os.system(str(python_exe)+' '
-                    +str(BetaBeatsrc_path)+'hole_in_one.py'
-                    ' --optics'
-                    ' --accel skekb'
-                    ' --ring '+str(ringID)+
-                    ' --compensation none'
-                    # ' --nonlinear rdt'
-                    # ' --second_order_dispersion'
-                    #' --union'
-                    ' --model_dir '+str(model_path)+
-                    ' --outputdir '+str(os.path.join(optics_output_path, 'average/' ))+
-                    ' --files '+str(allff))
-        else:
-            p = Popen([python_exe,
-                        BetaBeatsrc_path + 'GetLLM/GetLLM.py',
-                        '--model', model_path + '/twiss.dat',
-                        '--accel', 'skekb',
-                        '--files', str(allff),
-                        '-k 10000',
-                        '-e 10000',
-                        '-b', 'm',
-                        '--coupling', '0',
-                        '--output', os.path.join(optics_output_path, 'average/')])    
-            p.wait()
-
-    else:
-        for i, run in enumerate(sdds_files):
-            start = time.time()
-            print('Working on file ' + str(i+1) + '/' + str(len(sdds_files)) + ': ' + str(run) )
+    names = []
+    commands = []
+    if all_files_flag != True:
+        for run in [ff for ff in sdds_files if files is None or ff in files]:
             if py_version > 2:
-                p = Popen([python_exe,
+                commands.append([python_exe,
                         BetaBeatsrc_path + 'hole_in_one.py',
                         '--optics',
                         '--files', os.path.join(harmonic_output_path, run),
@@ -508,42 +1015,79 @@ def optics_analysis(py_version, python_exe, BetaBeatsrc_path, model_path,
                         '--model_dir', model_path,
                         '--accel', 'skekb',
                         '--ring', ringID,
-                        # ' --nonlinear rdt',
+                        # '--nonlinear', 'rdt',
                         '--compensation','none'])
             else:
-                p = Popen([python_exe,
+                commands.append([python_exe,
                         BetaBeatsrc_path + 'GetLLM/GetLLM.py',
                         '--model', model_path + '/twiss.dat',
                         '--accel', 'skekb',
                         '--files', os.path.join(harmonic_output_path, run),
                         '-b','m',
                         '--coupling', '0',
-                        '--output', os.path.join(optics_output_path, run)])      
-            p.wait()
+                        '--output', os.path.join(optics_output_path, run)])
+            names.append(run)
+
+    if all_files_flag == True or with_average == True:
+        allff = [os.path.join(harmonic_output_path, ff) for ff in sdds_files]
+        if py_version > 2:
+            commands.append([python_exe,
+                    BetaBeatsrc_path + 'hole_in_one.py',
+                    '--optics',
+                    '--accel', 'skekb',
+                    '--ring', ringID,
+                    '--compensation', 'none',
+                    # '--nonlinear', 'rdt',
+                    # '--second_order_dispersion',
+                    # '--union',
+                    '--model_dir', model_path,
+                    '--outputdir', os.path.join(optics_output_path, 'average/'),
+                    '--files'] + allff)
+        else:
+            commands.append([python_exe,
+                    BetaBeatsrc_path + 'GetLLM/GetLLM.py',
+                    '--model', model_path + '/twiss.dat',
+                    '--accel', 'skekb',
+                    '--files', ','.join(allff),
+                    '-k 10000',
+                    '-e 10000',
+                    '-b', 'm',
+                    '--coupling', '0',
+                    '--output', os.path.join(optics_output_path, 'average/')])
+        names.append('average')
+
+    if inprocess and py_version > 2:
+        status = run_omc3(commands, names, jobs, log_path(optics_output_path), BetaBeatsrc_path)
+    elif jobs > 1:
+        print('Running ' + str(len(commands)) + ' optics analyses on ' + str(jobs) + ' processes, logs are written to ' + log_path(optics_output_path))
+        status = run_commands(commands, names, jobs, log_path(optics_output_path))
+    else:
+        status = {}
+        for i, run in enumerate(names):
+            start = time.time()
+            print('Working on file ' + str(i+1) + '/' + str(len(names)) + ': ' + str(run) )
+            status[run] = Popen(commands[i]).wait()
             finish = time.time() - start
-            # timer('Optics analysis [single]', i, len(sdds_files), finish)
-         
+            # timer('Optics analysis [single]', i, len(names), finish)
+    print_status('Optics analysis', status)
+
     return print("*******************************************\n",
           "Optics analysis finished \n",
           "*******************************************")
 
 
-def asynch_analysis(python_exe, optics_output_path, main_output_path, model_path, ringID):
+def asynch_analysis(optics_output_path, main_output_path, model_path, ringID):
     """
-    Function to call checkAsync.py script to check phase output for
-    unsynched BPMs.
+    Function to check phase output for unsynched BPMs with checkAsync.py,
+    all runs of both planes in this process.
     """
+    from checkAsync import check_async
     sdds_dir = os.path.join(main_output_path, 'unsynched_sdds')
-    sdds = os.path.join(sdds_dir, os.listdir(sdds_dir)[1])
-
-    for axis in ['x', 'y']:
-        os.system(str(python_exe)+
-                   ' checkAsync.py'
-                   ' --optics_output_dir '+ optics_output_path +
-                   ' --async_output_dir '+ main_output_path + 'outofphase' + axis + '/'+
-                   ' --sdds ' + str(sdds) +
-                   ' --axis '+ axis +
-                   ' --ring '+ ringID)
+    sdds = os.path.join(sdds_dir, list_sdds(sdds_dir)[0])
+
+    check_async(optics_output_path,
+                dict((axis, main_output_path + 'outofphase' + axis + '/') for axis in ['x', 'y']),
+                sdds, ringID)
     return print(" ********************************************\n",
                  "Asynchronous analysis finished\n",
                  "********************************************")
@@ -569,65 +1113,45 @@ def asynch_analysis(python_exe, optics_output_path, main_output_path, model_path
 #                  "********************************************")
 
 
-def asynch_cmap(python_exe, sdds_path, optics_output_path, when='before'):
+def asynch_cmap(sdds_path, optics_output_path, when='before'):
     """
-    Function to call checkBPMs_colourmap.py script to see actual
-    phase difference between BPMs.
+    Function to plot the colourmap of plotBPMcolormap.py to see actual
+    phase difference between BPMs. Both planes are plotted in this process
+    and saved as png and pdf.
     """
-    for axis in ['x', 'y']:
-        for form in ['png', 'pdf']:
-            p = Popen([python_exe,
-                    'plotBPMcolormap.py',
-                    '--axis', axis,
-                    '--sdds_dir', sdds_path,
-                    '--optics_output_dir', optics_output_path,
-                    '--when', when,
-                    '--form', form,
-                    '--save'])
-            p.wait()
+    from plotBPMcolormap import plot_colormap
+    plot_colormap(sdds_path, optics_output_path, ['x', 'y'], when, ['png', 'pdf'])
     return print(" ********************************************\n",
                  '"BPM synchronisation colormap saved in main output directory."\n',
                  "********************************************")
 
 
-def bpm_calibration(python_exe, synched_sdds, ringID):
+def bpm_calibration(synched_sdds, ringID, jobs=1):
     """
-    Function to call checkCalibration.py script to calibrate amplitudes.
+    Function to calibrate amplitudes with checkCalibration.py,
+    both planes in this process, jobs lin files at the same time.
     Warning: ONLY tested using python 3 !
     """
-    for plane in ['x','y']:
-        os.system(python_exe + ' checkCalibration.py'
-                    ' --sdds ' + synched_sdds +
-                    ' --plane ' + plane +
-                    ' --ring ' + ringID )
+    from checkCalibration import check_calibration
+    check_calibration(synched_sdds, ['x', 'y'], jobs)
 
 
-def calib_hist(python_exe, synched_sdds, optics_output, when='before'):
+def calib_hist(synched_sdds, optics_output, when='before'):
     """
-    Function to call plotBPMCalibEstHist.py to make histogram of
-    (beta_amp - beta_phase)/beta_phase  beating.
+    Function to make histograms of (beta_amp - beta_phase)/beta_phase
+    beating with plotBPMCalibEstHist.py, both planes in this process.
     """
-    for plane in ['x', 'y']:
-        for form in ['png', 'pdf']:
-            os.system(python_exe + ' plotBPMCalibEstHist.py' +
-                        ' --sdds ' + synched_sdds +
-                        ' --phase ' + optics_output +
-                        ' --axis ' + plane + 
-                        ' --when ' + when +
-                        ' --pngpdf ' + form )
+    from plotBPMCalibEstHist import plot_calib_hist
+    plot_calib_hist(synched_sdds, optics_output, ['x', 'y'], when, ['png', 'pdf'])
 
 
-def freq_spec(python_exe, sdds, model):
+def freq_spec(sdds, model, jobs=1):
     """
-    Function to call plotFrequency.py to make plot of frequency spectrum for each BPM.
+    Function to plot the frequency spectrum for each BPM with plotFrequency.py,
+    rendered by jobs processes.
     """
-    # for plane in ['x']:
-    #     for form in ['png']:
-    os.system(python_exe + ' plotFrequency.py' +
-                ' --sdds ' + sdds +
-                ' --model ' + model )
-                # ' --axis ' + plane + 
-                # ' --pngpdf ' + form )
+    from plotFrequency import plot_frequency
+    plot_frequency(sdds, model, jobs)
 
 
 def chromatic_analysis(model_path, optics_output):
@@ -637,20 +1161,7 @@ def chromatic_analysis(model_path, optics_output):
     """
 
     if os.path.exists(os.path.join(model_path, 'tune_over_mom.txt')) == False:
-        fo = open(os.path.join(model_path, 'tune_over_mom.txt'),'w')
-        all_twiss = [ii for ii in os.listdir(model_path) if 'twiss_dp0' in ii]
-        print(all_twiss)
-
-        fo.write('DPP \t QX \t QY \n')
-        for tw in all_twiss:
-            dpp = tw[10:-4]
-            import tfs
-            tw_tfs = tfs.read(os.path.join(model_path, tw))
-            Qx = str(tw_tfs.Q1)
-            Qy = str(tw_tfs.Q2)
-            fo.write(dpp+'\t'+Qx+'\t'+Qy+'\n')
-        fo.close()
-    else: pass
+        write_tune_over_mom(model_path)
 
     for plane in ['x', 'y']:
         for pngpdf in ['png', 'pdf']:
@@ -659,13 +1170,13 @@ def chromatic_analysis(model_path, optics_output):
             if os.path.isfile(fo3): ff = fo3
             else: ff = fo2
 
-            with open(ff) as fo:
-                lines = fo.readlines()
-            fo.close()
-            dpp_meas = np.array([float(lines[11+i].split()[1]) for i in range(len(lines[11:]))])
-
-            Q = np.array([float(lines[11+i].split()[3]) for i in range(len(lines[11:]))])
-            Q_err = [float(lines[11+i].split()[4]) for i in range(len(lines[11:]))]
+            table = read_tfs(ff)[1]
+            dpp_meas = table['DPP']
+            Q = table['Q' + plane.upper()]
+            if ff == fo3:
+                Q_err = table['ERRQ' + plane.upper()]
+            else:
+                Q_err = table['Q' + plane.upper() + 'RMS']
             
             fit, cov = np.polyfit(dpp_meas, Q, 3, cov=True)
             poly = np.poly1d(fit)
@@ -722,7 +1233,7 @@ def chromatic_analysis(model_path, optics_output):
             try:
                 size=24
                 num=1
-                import matplotlib.pyplot as plt
+                plt = pyplot()
                 plt.figure(figsize=(12,5))
                 if plane == 'x':
                     # plt.plot(dpp*1e4, np.array(poly_mdl(dpp)-poly_mdl(0.0))*1e3, label = r"$Q'_{x}^{\rm{mdl}}$ = "+str(round(chrom1_mdl(0.0),2)), c='C3')
@@ -783,112 +1294,155 @@ def chromatic_analysis(model_path, optics_output):
 def coupling_analysis(model_path, sdds_output, harmonic_output, optics_output, all_files_flag):
     """
     Computes f1001 and writes them to an output file.
+    The f1001 of all runs are computed at once on the BPM x run matrix,
+    with all_files_flag they are averaged into average/f1001.tfs.
     WARNING: ONLY TESTED FOR PYTHON 3!
     """
-    all_bpms = read_bpms(os.path.join(sdds_output, os.listdir(sdds_output)[0]))
-    all_sdds = [sd for sd in os.listdir(sdds_output) if 'sdds' in sd]
+    all_sdds = list_sdds(sdds_output)
+    all_bpms = read_bpms(os.path.join(sdds_output, all_sdds[0]))
     
     import tfs
     import pandas as pd
+    from robustStats import sigma_clip, weighted_mean
+
+    # BPM x run matrices, NaN where a BPM is missing in one of the planes
+    AMP_01H = np.full((len(all_bpms), len(all_sdds)), np.nan)
+    ERRAMP_01H = np.full(AMP_01H.shape, np.nan)
+    AMP_10V = np.full(AMP_01H.shape, np.nan)
+    ERRAMP_10V = np.full(AMP_01H.shape, np.nan)
+    for k, sdds in enumerate(all_sdds):
+        tablex = read_tfs(os.path.join(harmonic_output, sdds+'.linx'))[1]
+        tabley = read_tfs(os.path.join(harmonic_output, sdds+'.liny'))[1]
+        AMP_01H[:, k] = align_on_bpms(all_bpms, tablex['NAME'], tablex['AMP01'])
+        ERRAMP_01H[:, k] = align_on_bpms(all_bpms, tablex['NAME'], tablex['ERRAMP01'])
+        AMP_10V[:, k] = align_on_bpms(all_bpms, tabley['NAME'], tabley['AMP10'])
+        ERRAMP_10V[:, k] = align_on_bpms(all_bpms, tabley['NAME'], tabley['ERRAMP10'])
+
+    av_f1001 = 0.5*((AMP_01H*AMP_10V)**0.5)
+    err_av_f1001 = ( (ERRAMP_01H*AMP_10V)**2 / (16*(AMP_01H*AMP_10V)) + (ERRAMP_10V*AMP_01H)**2 /(16*(AMP_01H*AMP_10V)))**0.5
 
     if all_files_flag is not True:
-        for sdds in all_sdds:                        
-            linx = os.path.join(harmonic_output, sdds+'.linx')
-            liny = os.path.join(harmonic_output, sdds+'.liny')
-            
-            with open(linx) as fx: linesx=fx.readlines()[7:]
-            fx.close()
-            with open(liny) as fy: linesy=fy.readlines()[7:]
-            fy.close()
-
-            bpmx = [linesx[i].split()[0] for i in range(len(linesx)) ]
-            AMP_01H =  ([float(linesx[i].split()[20]) for i in range(len(linesx)) ])
-            ERRAMP_01H =  ([float(linesx[i].split()[-9]) for i in range(len(linesx)) ])
-            
-            bpmy = [linesy[i].split()[0] for i in range(len(linesy)) ]
-            AMP_10V =  ([float(linesy[i].split()[20]) for i in range(len(linesy)) ])
-            ERRAMP_10V =  ([float(linesy[i].split()[-9]) for i in range(len(linesy)) ])
-
-            false_bpm = []
-            
-            for i, b in enumerate(all_bpms):    
-                if b not in bpmx: 
-                    AMP_01H.insert(i, 1)
-                    ERRAMP_01H.insert(i, 1)
-                    false_bpm.append(b)
-                if b not in bpmy:
-                    AMP_10V.insert(i, 1)
-                    ERRAMP_10V.insert(i, 1)
-                    false_bpm.append(b)
-            #print(false_bpm)
-            AMP_01H = np.array(AMP_01H)
-            ERRAMP_01H = np.array(ERRAMP_01H)
-            AMP_10V = np.array(AMP_10V)
-            ERRAMP_10V = np.array(ERRAMP_10V)
-            
-            av_f1001 = 0.5*((AMP_01H*AMP_10V)**0.5)
-            err_av_f1001 = ( (ERRAMP_01H*AMP_10V)**2 / (16*(AMP_01H*AMP_10V)) + (ERRAMP_10V*AMP_01H)**2 /(16*(AMP_01H*AMP_10V)))**0.5
-
-            f1001_fin = []
-            f1001_err_fin = []            
-            for i, bpm in enumerate(all_bpms):
-                f1001_fin.append(np.NaN) if bpm in false_bpm else f1001_fin.append(av_f1001[i])
-                f1001_err_fin.append(np.NaN) if bpm in false_bpm else f1001_err_fin.append(err_av_f1001[i])
-            
-            df = pd.DataFrame(zip(f1001_fin, f1001_err_fin), columns=['|F1001|','ERR|F1001|'], index=all_bpms)
+        for k, sdds in enumerate(all_sdds):
+            df = pd.DataFrame(zip(av_f1001[:, k], err_av_f1001[:, k]), columns=['|F1001|','ERR|F1001|'], index=all_bpms)
             tfs.write(os.path.join(optics_output, sdds+'/f1001.tfs'), df, save_index=True)
 
-
     if all_files_flag == True:
+        # error weighted mean over the runs, and mean and spread without outliers
+        f1001_mean, f1001_err = weighted_mean(av_f1001, err_av_f1001, axis=1)
+        clipped = sigma_clip(av_f1001, axis=1)
+        df = pd.DataFrame({'|F1001|': f1001_mean, 'ERR|F1001|': f1001_err,
+                           'MEAN|F1001|': clipped.mean(axis=1).filled(np.nan), 'STD|F1001|': clipped.std(axis=1).filled(np.nan),
+                           'NRUNS': clipped.count(axis=1)},
+                          columns=['|F1001|', 'ERR|F1001|', 'MEAN|F1001|', 'STD|F1001|', 'NRUNS'], index=all_bpms)
+        if not os.path.exists(os.path.join(optics_output, 'average')):
+            os.makedirs(os.path.join(optics_output, 'average'))
+        tfs.write(os.path.join(optics_output, 'average/f1001.tfs'), df, save_index=True)
+
+
+def plot_optics(optics_output, model, ringID, all_files_flag, jobs=1):
+    """
+    Function to plot all optics from OMC3 output with plotOptics.py,
+    both planes, the folders rendered by jobs processes.
+    WARNING: only tested with python 3!
+    """
+    from plotOptics import plot_optics as plot_optics_files
+    plot_optics_files(optics_output, model, ['x', 'y'], all_files_flag, ['png', 'pdf'], jobs)
 
-        for i,sdds in enumerate(all_sdds):
-            df = tfs.read(os.path.join(optics_output, str(sdds)+'/f1001.tfs'))
-            
-            if i > 0:
-                frame=[all_meas, df]
-                all_meas = pd.concat(frame, axis=1)
-                
-            else: 
-                all_meas = df
-
-        df_f1001_mean = all_meas['|F1001|'].mean(axis=1)
-        df_f1001_staterr = all_meas['|F1001|'].std(axis=1)
 
-        #print(all_meas['ERR|F1001|']**2)
+def sdds_turns(sdds, jobs=1):
+    """
+    Function to plot measured beam positions over turns with plotSDDS.py,
+    rendered by jobs processes.
+    """
+    from plotSDDS import plot_sdds
+    plot_sdds(sdds, jobs)
 
-        
 
+# ====================================================
+# To be used in checkAsync.py and checkCalibration.py
+# ====================================================
+def read_tfs(file):
+    """
+    Reads a TFS file once. Returns the header ('@' lines) as dictionary
+    and the columns as dictionary of arrays, keyed by the names in the
+    '*' line and in the order of the file. Columns of type %s are strings
+    without quotes, %d integers and all other columns floats.
+    """
+    header = {}
+    names = []
+    types = []
+    rows = []
+    with open(file) as f:
+        for line in f:
+            if line.startswith('@'):
+                parts = line[1:].split(None, 2)
+                if len(parts) == 3:
+                    header[parts[0]] = tfs_value(parts[1], parts[2].strip())
+            elif line.startswith('*'):
+                names = line.split()[1:]
+            elif line.startswith('$'):
+                types = line.split()[1:]
+            elif line.strip():
+                rows.append(line.split())
+
+    columns = list(zip(*rows)) if rows else [()] * len(names)
+    table = {}
+    for i, name in enumerate(names):
+        fmt = types[i] if i < len(types) else '%le'
+        if fmt.endswith('s'):
+            table[name] = np.array([val.strip('"') for val in columns[i]], dtype=str)
+        elif fmt.endswith('d'):
+            table[name] = np.array(columns[i], dtype=float).astype(int)
+        else:
+            table[name] = np.array(columns[i], dtype=float)
+    return header, table
 
 
-def plot_optics(python_exe, optics_output, model, ringID, all_files_flag):
+def tfs_value(fmt, value):
     """
-    Function to call script to plot all optics from OMC3 output.
-    WARNING: only tested with python 3!
+    Converts a TFS header value according to its format.
     """
-    for axis in ['x', 'y']:
-        for pngpdf in ['png', 'pdf']:
-            os.system(python_exe + ' plotOptics.py ' +
-                        ' --dir ' + optics_output +
-                        ' --model ' + model + 
-                        ' --axis ' + axis +
-                        ' --ring ' + ringID +
-                        ' --allfiles ' + str(all_files_flag) +
-                        ' --pngpdf ' + pngpdf )
+    if fmt.endswith('s'):
+        return value.strip('"')
+    elif fmt.endswith('d'):
+        return int(value)
+    return float(value)
 
 
-def sdds_turns(python_exe, sdds):
+def write_tfs(file, header, table):
     """
-    Function to call plotSDDS.py to make plot of measured beam positions over turns.
+    Writes a TFS file from a header dictionary and a dictionary
+    of columns (as returned by read_tfs). Strings are written as %s,
+    integers as %d and all other values as %le.
     """
-    os.system(python_exe + ' plotSDDS.py' +
-                ' --sdds ' + sdds )
-                # ' --axis ' + plane + 
-                # ' --pngpdf ' + form )
+    def fmt(values):
+        values = np.asarray(values)
+        if values.dtype.kind in 'US':
+            return '%s'
+        elif values.dtype.kind in 'iu':
+            return '%d'
+        return '%le'
+
+    def value(val, form):
+        if form == '%s':
+            return '"' + str(val) + '"'
+        elif form == '%d':
+            return str(int(val))
+        return repr(float(val))
+
+    names = list(table)
+    forms = [fmt(table[name]) for name in names]
+    with open(file, 'w') as f:
+        for key in header:
+            form = fmt([header[key]])
+            f.write('@ ' + key.ljust(20) + ' ' + form.ljust(5) + ' ' + value(header[key], form) + '\n')
+        f.write('* ' + ' '.join([name.rjust(20) for name in names]) + '\n')
+        f.write('$ ' + ' '.join([form.rjust(20) for form in forms]) + '\n')
+        columns = [[value(val, form) for val in table[name]] for name, form in zip(names, forms)]
+        for row in zip(*columns):
+            f.write('  ' + ' '.join([val.rjust(20) for val in row]) + '\n')
 
 
-# ====================================================
-# To be used in checkAsync.py and checkCalibration.py
-# ====================================================
 def read_phase(datapath, axis):
     """
     Reads getphase*.out and returns required columns as arrays.
@@ -897,36 +1451,24 @@ def read_phase(datapath, axis):
     fo3 = os.path.join(datapath, 'phase_' + axis + '.tfs')
    
     if os.path.isfile(fo3):
-        ff = fo3
-        with open(ff) as f:
-            lines=f.readlines()
-        S1 = [float(lines[10+i].split()[0]) for i in range(len(lines[10:]))]
-        S2 = [float(lines[10+i].split()[3]) for i in range(len(lines[10:]))]
-        Sall = np.hstack([S1, S2[-1]])
-        name1 = [lines[10+i].split()[2] for i in range(len(lines[10:]))]
-        name2 = [lines[10+i].split()[4] for i in range(len(lines[10:]))]
-        namesall = np.hstack([name1, name2[-1]])
-        deltaph = [float(lines[10+i].split()[-2]) for i in range(len(lines[10:]))]
-        phx = [float(lines[10+i].split()[5]) for i in range(len(lines[10:]))]
-        phxmdl = [float(lines[10+i].split()[7]) for i in range(len(lines[10:]))]
-        Qx = float(lines[6].split()[3])
-        Qy = float(lines[7].split()[3])
+        header, table = read_tfs(fo3)
+        Sall = np.hstack([table['S'], table['S2'][-1:]])
+        namesall = np.hstack([table['NAME'], table['NAME2'][-1:]])
+        deltaph = table['DELTAPHASE' + axis.upper()]
+        phx = table['PHASE' + axis.upper()]
+        phxmdl = table['PHASE' + axis.upper() + 'MDL']
+        Qx = header['Q1']
+        Qy = header['Q2']
 
     elif os.path.isfile(fo2):
-        ff = fo2
-        with open(ff) as f:
-            lines=f.readlines()
-        S1 = [float(lines[11+i].split()[2]) for i in range(len(lines[11:]))]
-        S2 = [float(lines[11+i].split()[3]) for i in range(len(lines[11:]))]
-        Sall = np.hstack([S1, S2[-1]])
-        name1 = [lines[11+i].split()[0] for i in range(len(lines[11:]))]
-        name2 = [lines[11+i].split()[1] for i in range(len(lines[11:]))]
-        namesall = np.hstack([name1, name2[-1]])
-        phx = np.array([float(lines[11+i].split()[5]) for i in range(len(lines[11:]))])
-        phxmdl = np.array([float(lines[11+i].split()[7]) for i in range(len(lines[11:]))])
+        header, table = read_tfs(fo2)
+        Sall = np.hstack([table['S'], table['S1'][-1:]])
+        namesall = np.hstack([table['NAME'], table['NAME2'][-1:]])
+        phx = table['PHASE' + axis.upper()]
+        phxmdl = table['PH' + axis.upper() + 'MDL']
         deltaph = phx- phxmdl
-        Qx = float(lines[4].split()[3])
-        Qy = float(lines[6].split()[3])
+        Qx = header['Q1']
+        Qy = header['Q2']
 
     
     else:
@@ -939,24 +1481,21 @@ def read_phase(datapath, axis):
     # return Sall, namesall, deltaph, phx, phxmdl, Qx, Qy
 
 
-def read_phasetot(datapath, axis):
+def read_phasetot(datapath, axis, names=False):
     """
-    Reads getphasetot*.out and returns deltaphtot array.
+    Reads getphasetot*.out and returns deltaphtot array, and with
+    names the BPM names of its rows from the same file as well.
     """
     fo2 = os.path.join(datapath, 'getphasetot' + axis + '.out')
     fo3 = os.path.join(datapath, 'total_phase_' + axis + '.tfs')
     
     if os.path.isfile(fo3):
-        ff = fo3
-        with open(ff) as f:
-            lines = f.readlines()[8:]
-        deltaphtot = [float(lines[2+i].split()[-2]) for i in range(len(lines[2:]))]
+        table = read_tfs(fo3)[1]
+        deltaphtot = table['DELTAPHASE' + axis.upper()]
 
     elif os.path.isfile(fo2):
-        ff = fo2
-        with open(ff) as f:
-            lines = f.readlines()[11:]
-        deltaphtot = [float(lines[2+i].split()[-1]) for i in range(len(lines[2:]))]
+        table = read_tfs(fo2)[1]
+        deltaphtot = table['PHASE' + axis.upper()] - table['PH' + axis.upper() + 'MDL']
 
     else:
         return print(" ********************************************\n",
@@ -964,6 +1503,8 @@ def read_phasetot(datapath, axis):
                  '"No phase output files are found.. I stop now."\n',
                  "********************************************")
 
+    if names:
+        return table['NAME'], deltaphtot
     return deltaphtot
 
 
@@ -971,27 +1512,17 @@ def read_bpms(sdds):
     """
     Reads one sdds file and returns all BPM names as an array.
     """
-
-    with open(sdds) as f:
-        lines = f.readlines()
-    f.close()
-    bpm_lines = [lin for lin in lines if '0 M' in lin]
-    names = [bpm_lines[i].split()[1] for i in range(len(bpm_lines))]
-
-    return names
+    return read_bpm_index(sdds)
 
 
 def read_bet_phase(folder, plane):
     """
     Reads beta_phase_*.tfs and returns the beta function.
     """
-    file = os.path.join(folder, 'beta_phase_' + plane + '.tfs')
-    with open(file) as fo:
-        lines = fo.readlines()[15:]
-    fo.close()
-    beta_phase = [float(lines[i].split()[5]) for i in range(len(lines))]
-    beta_phase_err = [float(lines[i].split()[6]) for i in range(len(lines))]
-    bpms = [lines[i].split()[0].replace('"','') for i in range(len(lines))]
+    table = read_tfs(os.path.join(folder, 'beta_phase_' + plane + '.tfs'))[1]
+    beta_phase = table['BET' + plane.upper()]
+    beta_phase_err = table['ERRBET' + plane.upper()]
+    bpms = table['NAME']
     return beta_phase, beta_phase_err, bpms
 
 
@@ -999,12 +1530,9 @@ def read_bet_amp(folder, plane):
     """
     Reads beta_amplitude_*.tfs and returns the beta function.
     """
-    file = os.path.join(folder, 'beta_amplitude_' + plane + '.tfs')
-    with open(file) as fo:
-        lines = fo.readlines()[12:]
-    fo.close()
-    beta_amp = [float(lines[i].split()[3]) for i in range(len(lines))]
-    beta_amp_err = [float(lines[i].split()[4]) for i in range(len(lines))]
+    table = read_tfs(os.path.join(folder, 'beta_amplitude_' + plane + '.tfs'))[1]
+    beta_amp = table['BET' + plane.upper()]
+    beta_amp_err = table['ERRBET' + plane.upper()]
     return beta_amp, beta_amp_err
 
 
@@ -1039,9 +1567,10 @@ def reject_outliers(data, m=2):
     """
     Removes outliers in a list.
     Outliers are farther than m*stddev away from mean. 
+    NaN values are left out as well.
     """
-    data = [val for val in data if (abs(val-np.mean(data)) < m*np.std(data))]
-    return data
+    from robustStats import sigma_clip
+    return list(sigma_clip(data, m).compressed())
 
 
 # ====================================================
@@ -1051,19 +1580,42 @@ def BPMs_from_sdds(sddsfile):
     """
     Finds the complete list of BPMs from the sdds file.
     """
-    with open(sddsfile) as f:
-        lines = f.readlines()
-    lines = [line for line in lines if not line.startswith('#')]
+    return read_bpm_index(sddsfile)
 
-    BPMs = []
-    # badBPMs = []
-    for line in lines:
-        if line.startswith('0'):
-            BPMs.append(line.split()[1])
-            # if line.split()[3] == '.0000000000':
-            #     badBPMs.append(line.split()[1])
 
-    return BPMs #, badBPMs
+def read_bpm_index(sdds):
+    """
+    Returns the names of the BPMs in sdds (rows of the first plane).
+    The names are taken from the binary store or the <sdds>.bpms index
+    if they are up to date. Otherwise only the start of each orbit line
+    of the first plane is matched in the memory-mapped file, and the
+    index is written.
+    """
+    index = sdds + '.bpms'
+    if tbt_is_fresh(sdds):
+        return read_tbt_index(sdds)['x'][0]
+    if os.path.isfile(index) and os.path.getmtime(index) >= os.path.getmtime(sdds):
+        with open(index) as f:
+            return f.read().split()
+
+    names = []
+    if os.path.getsize(sdds) > 0:
+        with open(sdds, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            # the rows of the first plane come first, the scan stops at the first other row
+            for line in re.finditer(br'^([^#\s]\S*)[ \t]+(\S+)', mm, re.M):
+                if line.group(1) != b'0':
+                    if names:
+                        break
+                    continue
+                names.append(line.group(2).decode())
+            mm.close()
+    try:
+        with open(index, 'w') as f:
+            f.write('\n'.join(names) + '\n')
+    except (IOError, OSError):
+        pass
+    return names
 
 
 def get_all_outofsynch(async_output_dir):
@@ -1124,18 +1676,217 @@ def get_data_column(optics_output_dir, folder, data, column):
     Obtain desired data column from measurement run in phase
     output dir as an array.
     """
-    with open(optics_output_dir + folder + '/' + data) as f:
-        lines = f.readlines()
-    rows = [line for line in lines if line.split()[0] not in ['@', '*', '$']]
-    headers, = [line for line in lines if line.split()[0] == '*']
-    headers = headers.split()[1:]
-    all_dat = {}
-    for i in range(len(headers)):
-        if headers[i] in ['NAME', 'NAME2', 'TYPENAME']:
-            all_dat[headers[i]] = [rows[j].split()[i].replace('"','') for j in range(len(rows))]
-        else:
-            all_dat[headers[i]] = [float(rows[j].split()[i]) for j in range(len(rows))]
-    return all_dat[column]
+    return load_tfs(optics_output_dir + folder + '/' + data)[1][column].tolist()
+
+
+_tfs_cache = {}
+
+
+def load_tfs(file):
+    """
+    Same as read_tfs, but each file is parsed only once as long as it is
+    not modified. Later calls return the cached header and columns.
+    """
+    path = os.path.abspath(file)
+    mtime = os.path.getmtime(path)
+    if path not in _tfs_cache or _tfs_cache[path][0] != mtime:
+        _tfs_cache[path] = (mtime, read_tfs(path))
+    return _tfs_cache[path][1]
+
+
+def align_on_bpms(bpms, names, values):
+    """
+    Returns values ordered along bpms, matched by BPM name.
+    BPMs not in names are NaN. For repeated names the last value is taken,
+    as in get_dict_colormap.
+    """
+    names = np.asarray(names)[::-1]
+    values = np.asarray(values, dtype=float)[::-1]
+    names, first = np.unique(names, return_index=True)
+    values = values[first]
+    bpms = np.asarray(bpms)
+    aligned = np.full(len(bpms), np.nan)
+    if len(names) == 0:
+        return aligned
+    pos = np.clip(np.searchsorted(names, bpms), 0, len(names) - 1)
+    found = names[pos] == bpms
+    aligned[found] = values[pos[found]]
+    return aligned
+
+
+# ====================================================
+# Binary turn-by-turn store, written next to the sdds file
+# ====================================================
+def tbt_path(sdds):
+    """
+    Returns the folder of the binary turn-by-turn store of an sdds file.
+    """
+    return sdds + '.tbt'
+
+
+def tbt_is_fresh(sdds):
+    """
+    Checks if the binary store of sdds exists and is not older than sdds.
+    """
+    index = os.path.join(tbt_path(sdds), 'index.txt')
+    return os.path.isfile(index) and os.path.getmtime(index) >= os.path.getmtime(sdds)
+
+
+def turns_of(fields):
+    """
+    Number of turns of an orbit line split into plane, name, S and turns.
+    """
+    return len(fields[3].split()) if len(fields) > 3 else 0
+
+
+def check_turns(sdds, fields, nturns):
+    """
+    Raises a ValueError naming the BPM if its orbit line has not nturns turns.
+    """
+    if turns_of(fields) != nturns:
+        raise ValueError(sdds + ': BPM ' + fields[1] + ' (plane ' + fields[0] + ') has ' + str(turns_of(fields)) +
+                         ' turns, the first BPM of its plane ' + str(nturns) + '.')
+
+
+def parse_sdds(sdds, number=None):
+    """
+    Returns BPM names, S positions and the BPM x turn matrix of each plane
+    ('x', 'y') of the ASCII file sdds, read into memory, with only the first
+    number BPMs of each plane if number is given.
+    """
+    lines = {'0': [], '1': []}
+    with open(sdds) as f:
+        for line in f:
+            if line.startswith('#') or not line.strip():
+                continue
+            fields = line.split(None, 3)
+            if number is None or len(lines[fields[0]]) < number:
+                lines[fields[0]].append(fields)
+            elif all(len(lines[plane]) >= number for plane in lines):
+                break
+    planes = {}
+    for plane, axis in [('0', 'x'), ('1', 'y')]:
+        nturns = turns_of(lines[plane][0]) if lines[plane] else 0
+        data = np.empty((len(lines[plane]), nturns))
+        for row, fields in enumerate(lines[plane]):
+            check_turns(sdds, fields, nturns)
+            data[row] = np.array(fields[3].split(), dtype=float) if nturns else []
+        planes[axis] = ([fields[1] for fields in lines[plane]], np.array([float(fields[2]) for fields in lines[plane]]), data)
+    return planes
+
+
+def sdds_to_tbt(sdds, dtype='float64'):
+    """
+    Converts an ASCII sdds file into <sdds>.tbt/ containing x.npy and y.npy,
+    BPM x turn matrices which can be memory-mapped with numpy, and index.txt,
+    listing plane, name and S of every orbit line in the order of the sdds file.
+    """
+    # first pass: number of BPMs and number of turns per plane
+    rows = {'0': 0, '1': 0}
+    nturns = {}
+    with open(sdds) as f:
+        for line in f:
+            if line.startswith('#') or not line.strip():
+                continue
+            fields = line.split(None, 3)
+            plane = fields[0]
+            rows[plane] += 1
+            check_turns(sdds, fields, nturns.setdefault(plane, turns_of(fields)))
+
+    tmp = tempfile.mkdtemp(prefix=os.path.basename(sdds) + '.', dir=os.path.dirname(os.path.abspath(sdds)))
+    data = {}
+    for plane, axis in [('0', 'x'), ('1', 'y')]:
+        data[plane] = np.lib.format.open_memmap(os.path.join(tmp, axis + '.npy'), mode='w+',
+                                                dtype=dtype, shape=(rows[plane], nturns.get(plane, 0)))
+
+    # second pass: fill the matrices line by line
+    row = {'0': 0, '1': 0}
+    fi = open(os.path.join(tmp, 'index.txt'), 'w')
+    with open(sdds) as f:
+        for line in f:
+            if line.startswith('#') or not line.strip():
+                continue
+            fields = line.split(None, 3)
+            plane = fields[0]
+            data[plane][row[plane], :] = np.array(fields[3].split(), dtype=dtype)
+            row[plane] += 1
+            fi.write(plane + ' ' + fields[1] + ' ' + fields[2] + '\n')
+    fi.close()
+    for plane in data:
+        data[plane].flush()
+    del data
+
+    if os.path.exists(tbt_path(sdds)):
+        shutil.rmtree(tbt_path(sdds))
+    os.rename(tmp, tbt_path(sdds))
+    return tbt_path(sdds)
+
+
+def read_tbt_index(sdds):
+    """
+    Returns a dictionary with the BPM names and S positions of the
+    rows of each plane ('x', 'y') of the binary store of sdds.
+    """
+    index = {'x': ([], []), 'y': ([], [])}
+    with open(os.path.join(tbt_path(sdds), 'index.txt')) as f:
+        for line in f:
+            plane, name, s = line.split()
+            axis = 'x' if plane == '0' else 'y'
+            index[axis][0].append(name)
+            index[axis][1].append(float(s))
+    return index
+
+
+def read_tbt(sdds, axis):
+    """
+    Returns BPM names, S positions and the memory-mapped BPM x turn matrix
+    of plane axis ('x' or 'y') of sdds. The binary store is created first
+    if it is missing or older than sdds.
+    """
+    if not tbt_is_fresh(sdds):
+        sdds_to_tbt(sdds)
+    names, s = read_tbt_index(sdds)[axis]
+    data = np.load(os.path.join(tbt_path(sdds), axis + '.npy'), mmap_mode='r')
+    return names, np.array(s), data
+
+
+def read_first_bpms(sdds, number=2):
+    """
+    Returns BPM names, S positions and the BPM x turn matrix of the first
+    number BPMs of each plane ('x', 'y') of sdds. They are read from the
+    binary store if it is fresh, otherwise from the lines of the ASCII file,
+    no binary store is written.
+    """
+    if tbt_is_fresh(sdds):
+        first = {}
+        for axis in ['x', 'y']:
+            names, s, data = read_tbt(sdds, axis)
+            first[axis] = (names[:number], s[:number], np.array(data[:number]))
+        return first
+
+    return parse_sdds(sdds, number)
+
+
+def read_orbits(sdds, store=False):
+    """
+    Returns BPM names, S positions and the BPM x turn matrix of each plane
+    ('x', 'y') of sdds. The binary store is used if it is fresh, or written
+    first with store. Otherwise the ASCII file is read into memory and
+    nothing is written next to it.
+    """
+    if store or tbt_is_fresh(sdds):
+        return dict((axis, read_tbt(sdds, axis)) for axis in ['x', 'y'])
+    return parse_sdds(sdds)
+
+
+def convert_tbt(sdds_path, dtype='float64'):
+    """
+    Writes the binary store of all sdds files in sdds_path.
+    """
+    for sdds in list_sdds(sdds_path):
+        if not tbt_is_fresh(os.path.join(sdds_path, sdds)):
+            print('Writing binary turn-by-turn data of ' + sdds)
+            sdds_to_tbt(os.path.join(sdds_path, sdds), dtype)
 
 
 # ====================================================
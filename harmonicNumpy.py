@@ -0,0 +1,191 @@
+"""
+Harmonic analysis of turn-by-turn data with numpy, as a fast alternative
+to harpy when only the tunes and the main lines are needed.
+All BPMs of a plane are analysed at once on the BPM x turn matrix:
+the tune line is searched in the Hann windowed, zero padded FFT and then
+refined by a golden section search on the amplitude of the discrete
+Fourier transform. The (0,1) and (1,0) coupling lines are taken at the
+tune of the other plane. Results are written to <file>.linx and
+<file>.liny with the columns read by the optics, coupling and
+calibration analysis.
+"""
+
+from __future__ import print_function
+from optparse import OptionParser
+from datetime import datetime
+import os
+import numpy as np
+from func import read_orbits, write_tfs
+
+
+UNITS = {'m': 1., 'cm': 1e-2, 'mm': 1e-3, 'um': 1e-6}
+GOLDEN = (np.sqrt(5.) - 1.) / 2.
+
+
+def dft(signal, freqs, block=16):
+    """
+    Returns the discrete Fourier transform of every row of signal
+    at its own frequency in freqs. The phase factors are computed for
+    block rows at a time, so memory does not grow with the number of BPMs.
+    """
+    n = np.arange(signal.shape[1])
+    coef = np.empty(signal.shape[0], dtype=complex)
+    for start in range(0, signal.shape[0], block):
+        rows = slice(start, start + block)
+        coef[rows] = np.einsum('ij,ij->i', signal[rows], np.exp(-2j * np.pi * np.outer(freqs[rows], n)))
+    return coef
+
+
+def find_lines(signal, window, guess, tolerance, pad=4, iterations=20):
+    """
+    Returns frequency, amplitude and phase (in units of 2 pi) of the
+    strongest line of each row of signal within guess +- tolerance.
+    signal is already multiplied by window.
+    """
+    nturns = signal.shape[1]
+    npad = 2**int(np.ceil(np.log2(pad * nturns)))
+    spectrum = np.abs(np.fft.rfft(signal, n=npad, axis=1))
+    freqs = np.fft.rfftfreq(npad)
+    band = np.where(np.abs(freqs - guess) <= tolerance)[0]
+    peak = freqs[band[np.argmax(spectrum[:, band], axis=1)]]
+
+    # golden section search between the neighbouring FFT bins
+    low = peak - 1. / npad
+    high = peak + 1. / npad
+    for i in range(iterations):
+        f1 = high - GOLDEN * (high - low)
+        f2 = low + GOLDEN * (high - low)
+        left = np.abs(dft(signal, f1)) > np.abs(dft(signal, f2))
+        high = np.where(left, f2, high)
+        low = np.where(left, low, f1)
+    freq = (low + high) / 2.
+
+    coef = dft(signal, freq) * 2. / np.sum(window)
+    return freq, np.abs(coef), np.angle(coef) / (2 * np.pi)
+
+
+def fold(tune):
+    """
+    Returns the frequency in [0, 0.5] at which a tune appears in the
+    spectrum of a real signal and whether it is mirrored.
+    """
+    tune = tune % 1.
+    return (1. - tune, True) if tune > 0.5 else (tune, False)
+
+
+def main_lines(signal, window, tune, tolerance):
+    """
+    Tune, amplitude and phase of the main line, searched around tune.
+    """
+    guess, mirrored = fold(tune)
+    freq, amp, phase = find_lines(signal, window, guess, tolerance)
+    if mirrored:
+        return 1. - freq, amp, -phase
+    return freq, amp, phase
+
+
+def line_at(signal, window, tune):
+    """
+    Amplitude and phase of the line at the given tune.
+    """
+    guess, mirrored = fold(tune)
+    # the same frequency for all BPMs, one vector of phase factors
+    coef = signal.dot(np.exp(-2j * np.pi * guess * np.arange(signal.shape[1]))) * 2. / np.sum(window)
+    phase = np.angle(coef) / (2 * np.pi)
+    return np.abs(coef), -phase if mirrored else phase
+
+
+def prepare(data, nturns, unit):
+    """
+    Returns the BPM x turn matrix in m without closed orbit, the closed
+    orbit, the peak to peak and the Hann window.
+    """
+    orbit = np.array(data[:, :nturns], dtype=float) * UNITS[unit]
+    co = orbit.mean(axis=1)
+    orbit = orbit - co[:, None]
+    window = np.hanning(orbit.shape[1])
+    return orbit, co, orbit.max(axis=1) - orbit.min(axis=1), window
+
+
+def harmonic_numpy(sdds, outputdir, tunes, tolerance=0.01, nturns=None, unit='mm',
+                   clean_limit=1e-3, spectra=False, tbt=False):
+    """
+    Analyses both planes of sdds and writes outputdir/<file>.linx and .liny.
+    tunes are the fractional tune guesses (x, y), the search range around
+    them is limited to half the distance of the two tunes. BPMs without
+    signal and BPMs whose tune differs by more than clean_limit from the
+    median tune are left out. With spectra the windowed spectra of all BPMs are
+    written to <file>.ampsx/.freqsx (and y). The turn-by-turn data is read
+    from the binary store if it is fresh (with tbt it is written first),
+    otherwise from the sdds file.
+    """
+    tolerance = min(tolerance, abs(fold(tunes[0])[0] - fold(tunes[1])[0]) / 2.)
+    orbits = read_orbits(sdds, tbt)
+    planes = {}
+    for axis, tune in zip(['x', 'y'], tunes):
+        names, s, data = orbits[axis]
+        orbit, co, pk2pk, window = prepare(data, nturns or data.shape[1], unit)
+        good = pk2pk > 0
+        freq, amp, phase = main_lines(orbit[good] * window, window, tune, tolerance)
+        keep = np.abs(freq - np.median(freq)) <= clean_limit
+        good[good] = keep
+        planes[axis] = {'names': np.array(names)[good], 's': s[good], 'orbit': orbit[good], 'window': window,
+                        'co': co[good], 'pk2pk': pk2pk[good], 'tune': freq[keep], 'amp': amp[keep], 'phase': phase[keep]}
+
+    name = os.path.basename(sdds)
+    time = datetime.now().strftime('%Y_%m_%d@%H_%M_%S_%f')
+    for axis, other, num, line in [('x', 'y', '1', '01'), ('y', 'x', '2', '10')]:
+        pl = planes[axis]
+        signal = pl['orbit'] * pl['window']
+        nturns = signal.shape[1]
+        other_tune = np.mean(planes[other]['tune'])
+        amp2, phase2 = line_at(signal, pl['window'], other_tune)
+
+        # noise from the residual after removing the main line
+        n = np.arange(nturns)
+        residual = pl['orbit'] - pl['amp'][:, None] * np.cos(2 * np.pi * (np.outer(pl['tune'], n) + pl['phase'][:, None]))
+        noise = residual.std(axis=1)
+        err_amp = noise * np.sqrt(2. / nturns)
+
+        P = axis.upper()
+        header = {'Q' + num: float(np.mean(pl['tune'])), 'Q' + num + 'RMS': float(np.std(pl['tune'])),
+                  'NATQ' + num: float(np.mean(pl['tune'])), 'NATQ' + num + 'RMS': float(np.std(pl['tune'])),
+                  'TIME': time}
+        table = {'NAME': pl['names'], 'S': pl['s'], 'BPM_RES': noise, 'PK2PK': pl['pk2pk'],
+                 'CO': pl['co'], 'CORMS': noise / np.sqrt(nturns), 'NOISE': noise,
+                 'TUNE' + P: pl['tune'], 'AMP' + P: pl['amp'], 'MU' + P: pl['phase'],
+                 'NATTUNE' + P: pl['tune'], 'NATAMP' + P: pl['amp'], 'NATMU' + P: pl['phase'],
+                 'FREQ' + line: np.full(len(pl['names']), other_tune % 1.), 'AMP' + line: amp2 / pl['amp'], 'PHASE' + line: phase2,
+                 'ERRMU' + P: err_amp / pl['amp'] / (2 * np.pi), 'ERRNATMU' + P: err_amp / pl['amp'] / (2 * np.pi),
+                 'ERRPHASE' + line: err_amp / np.maximum(amp2, err_amp) / (2 * np.pi),
+                 'ERRAMP' + P: err_amp, 'ERRNATAMP' + P: err_amp, 'ERRAMP' + line: err_amp / pl['amp']}
+        write_tfs(os.path.join(outputdir, name + '.lin' + axis), header, table)
+
+        if spectra:
+            amps = np.abs(np.fft.rfft(signal, axis=1)) * 2. / np.sum(pl['window'])
+            freqs = np.tile(np.fft.rfftfreq(nturns), (len(pl['names']), 1))
+            for ext, values in [('.amps', amps), ('.freqs', freqs)]:
+                np.savetxt(os.path.join(outputdir, name + ext + axis), values.T, fmt='%.8e',
+                           header='@ TIME %s "' + time + '"\n* ' + ' '.join(pl['names']) + '\n$ ' + ' '.join(['%le'] * len(pl['names'])),
+                           comments='')
+
+    return [float(planes['x']['tune'].mean()), float(planes['y']['tune'].mean())]
+
+
+if __name__ == "__main__":
+
+    parser = OptionParser()
+    parser.add_option("-f", "--file",  dest="file", help="Path to sdds file.", action="store")
+    parser.add_option("-o", "--outputdir",  dest="outputdir", help="Folder where the lin files will be stored.", action="store")
+    parser.add_option("-x", "--tunex",  dest="tunex", help="Fractional horizontal tune guess.", action="store", type=float)
+    parser.add_option("-y", "--tuney",  dest="tuney", help="Fractional vertical tune guess.", action="store", type=float)
+    parser.add_option("-t", "--tolerance",  dest="tolerance", help="Tune search range around the guess.", action="store", type=float, default=0.01)
+    parser.add_option("-n", "--turns",  dest="turns", help="Number of turns to analyse.", action="store", type=int)
+    parser.add_option("-u", "--unit",  dest="unit", help="Unit of the sdds data: m, cm, mm or um.", action="store", default='mm')
+    parser.add_option("-s", "--spectra",  dest="spectra", help="Also write the spectra of all BPMs.", action="store_true", default=False)
+    parser.add_option("-b", "--tbt",  dest="tbt", help="Write the binary turn-by-turn store of the file if it is missing.", action="store_true", default=False)
+    (options, args) = parser.parse_args()
+
+    tunes = harmonic_numpy(options.file, options.outputdir, [options.tunex, options.tuney],
+                           options.tolerance, options.turns, options.unit, spectra=options.spectra, tbt=options.tbt)
+    print('Qx = ' + str(tunes[0]) + ', Qy = ' + str(tunes[1]))
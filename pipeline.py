@@ -0,0 +1,145 @@
+"""
+Runs the analysis stages of run_SOMA.py in the order of their dependencies,
+rebuilding only what is out of date.
+
+A stage is a dictionary made by stage(). Its units function returns, at the
+time the stage is reached, a list of (unit, inputs, outputs) with the files
+one unit (usually one measurement run) reads and writes. Only units whose
+outputs are missing or older than their inputs are passed to the run
+function of the stage. If an input is newer but its content did not change
+since the outputs were last built (recorded in a state file), the unit is
+not rebuilt either.
+"""
+from __future__ import print_function
+import os
+import json
+import hashlib
+
+
+def stage(name, units, run, requires=()):
+    """
+    Returns a pipeline stage. run is called with the list of stale units.
+    """
+    return {'name': name, 'units': units, 'run': run, 'requires': list(requires)}
+
+
+def path_mtime(path):
+    """
+    Returns the modification time of a file, for folders the latest one of
+    all files inside. None if the file does not exist or the folder is empty.
+    """
+    if os.path.isfile(path):
+        return os.path.getmtime(path)
+    times = [os.path.getmtime(os.path.join(root, ff)) for root, dirs, files in os.walk(path) for ff in files]
+    return max(times) if times else None
+
+
+def file_hash(path):
+    """
+    Returns the SHA1 of the content of a file.
+    """
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def read_state(state_file):
+    if state_file and os.path.isfile(state_file):
+        with open(state_file) as f:
+            return json.load(f)
+    return {}
+
+
+def write_state(state_file, state):
+    if state_file:
+        with open(state_file + '.tmp', 'w') as f:
+            json.dump(state, f, indent=1, sort_keys=True)
+        os.rename(state_file + '.tmp', state_file)
+
+
+def outdated(inputs, outputs):
+    """
+    True if an output is missing or older than one of the inputs.
+    Units without outputs (e.g. plots) are always outdated.
+    """
+    out_times = [path_mtime(out) for out in outputs]
+    if not outputs or None in out_times:
+        return True
+    in_times = [tt for tt in [path_mtime(inp) for inp in inputs] if tt is not None]
+    return bool(in_times) and max(in_times) > min(out_times)
+
+
+def is_stale(key, inputs, outputs, state):
+    """
+    True if the unit has to be rebuilt. Inputs which are newer than the
+    outputs are compared with the content recorded at the last build.
+    """
+    if not outdated(inputs, outputs):
+        return False
+    if not outputs or None in [path_mtime(out) for out in outputs]:
+        return True
+    recorded = state.get(key)
+    if recorded is None:
+        return True
+    return any(recorded.get(inp) != file_hash(inp) for inp in inputs if os.path.isfile(inp))
+
+
+def required_stages(stages, targets):
+    """
+    Returns the names of the targets and of all stages they depend on.
+    """
+    by_name = dict((st['name'], st) for st in stages)
+    needed = set()
+    todo = list(targets)
+    while todo:
+        name = todo.pop()
+        if name not in needed:
+            needed.add(name)
+            todo.extend(by_name[name]['requires'])
+    return needed
+
+
+def run_pipeline(stages, targets, state_file=None, force=False):
+    """
+    Runs the targets and the stages they require, in the order of stages
+    (which has to list each stage after the ones it requires).
+    With force all units of the targets are rebuilt, the required stages
+    are still only rebuilt where they are out of date.
+    """
+    names = [st['name'] for st in stages]
+    for st in stages:
+        for req in st['requires']:
+            if names.index(req) > names.index(st['name']):
+                raise ValueError('Stage ' + st['name'] + ' is listed before ' + req + ', which it requires.')
+
+    needed = required_stages(stages, targets)
+    state = read_state(state_file)
+
+    for st in stages:
+        if st['name'] not in needed:
+            continue
+        units = st['units']()
+        if force and st['name'] in targets:
+            stale = [unit for unit, inputs, outputs in units]
+        else:
+            stale = [unit for unit, inputs, outputs in units
+                     if is_stale(st['name'] + ':' + unit, inputs, outputs, state)]
+
+        if not stale:
+            print(" ********************************************\n",
+                  st['name'] + ':\n',
+                  '"All ' + str(len(units)) + ' units are up to date, nothing to do."\n',
+                  "********************************************")
+            continue
+        print(" ********************************************\n",
+              st['name'] + ':\n',
+              '"Rebuilding ' + str(len(stale)) + '/' + str(len(units)) + ': ' + ', '.join(stale) + '"\n',
+              "********************************************")
+        st['run'](stale)
+
+        for unit, inputs, outputs in st['units']():
+            if unit in stale and outputs and not outdated(inputs, outputs):
+                state[st['name'] + ':' + unit] = dict((inp, file_hash(inp)) for inp in inputs if os.path.isfile(inp))
+        write_state(state_file, state)
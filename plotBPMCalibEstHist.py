@@ -1,53 +1,76 @@
 
 """
 Script to plot histograms of beta-beating before and after
-BPM calibration.
+BPM calibration. Both planes are plotted in one go, each
+histogram is saved in all requested formats.
 """
 
 from __future__ import print_function
 from optparse import OptionParser
-import matplotlib.pyplot as plt
 import os
 import numpy as np
-from func import read_bet_phase, read_bet_amp
+from func import read_bet_phase, read_bet_amp, read_bpms, align_on_bpms, list_sdds, pyplot
+from robustStats import median_mad, valid
+plt = pyplot()
 
 
-if __name__ == "__main__":
+def calib_beating(sdds_dir, phase_dir, axis):
+    """
+    Returns (beta_amp - beta_phase)/beta_phase in % of each measurement (rows)
+    and BPM (columns) as masked array, without values above 250 %.
+    """
+    all_sdds = list_sdds(sdds_dir)
+    all_bpms = read_bpms(os.path.join(sdds_dir, all_sdds[0]))
+    beat = np.full((len(all_sdds), len(all_bpms)), np.nan)
+    for k, sdds in enumerate(all_sdds):
+        folder = os.path.join(phase_dir, sdds)
+
+        beta_phase, beta_phase_err, bpms = read_bet_phase(folder, axis)
+        beta_amp, beta_amp_err = read_bet_amp(folder, axis)
+
+        beat[k] = align_on_bpms(all_bpms, bpms, 100*(beta_amp - beta_phase)/beta_phase)
+    beat = valid(beat)
+    return np.ma.masked_where(np.ma.abs(beat) > 250, beat)
+
 
+def plot_calib_hist(sdds_dir, phase_dir, axes=('x', 'y'), when='before', forms=('png', 'pdf')):
+    """
+    Plots the histogram of each plane in axes and saves it
+    once per format in forms next to sdds_dir.
+    """
     fix = 10
     fiy = 4.5
     size = 20
 
+    for axis in axes:
+        beat = calib_beating(sdds_dir, phase_dir, axis)
+        av = beat.mean()
+        median, mad = median_mad(beat, axis=None)
+        print('Beta-beating ' + axis + ' (' + when + '): mean ' + '%.2f' % av + ' %, median ' + '%.2f' % median +
+              ' %, MAD ' + '%.2f' % mad + ' % of ' + str(beat.count()) + ' values of all BPMs and measurements.')
+
+        plt.figure(figsize=(fix, fiy))
+        n, bins, patches  = plt.hist(beat.compressed(), bins=200)
+        plt.plot(np.array([av,av]), np.array([0,max(n)]), ls='--', color = 'grey', lw = 2)
+        plt.ylim(0, max(n))
+        plt.tick_params('both', labelsize=size)
+        if axis == 'x': plt.xlabel(r'$(\beta_{x, amp}-\beta_{x, ph}) / \beta_{x, ph}$ [%]', fontsize=size)
+        else: plt.xlabel(r'$(\beta_{y, amp}-\beta_{y, ph}) / \beta_{y, ph}$ [%]', fontsize=size)
+        plt.ylabel('Counts', fontsize=size)
+        plt.tight_layout()
+        for form in forms:
+            plt.savefig(sdds_dir+'../BPMcalib_'+when+'_'+axis+'.'+form)
+        plt.close()
+
+
+if __name__ == "__main__":
+
     parser = OptionParser()
     parser.add_option("-s", "--sdds",  dest="sdds", help="Folder of sdds files.", action="store")
     parser.add_option("-o", "--phase",  dest="phase", help="Folder of phase output files.", action="store")
-    parser.add_option("-a", "--axis",  dest="axis", help="Transverse plane, either x or y.", action="store")
+    parser.add_option("-a", "--axis",  dest="axis", help="Transverse plane, either x or y, comma separated for both.", action="store", default='x,y')
     parser.add_option("-w", "--when",  dest="when", help="Before or after calibration.", action="store")
-    parser.add_option("-p", "--pngpdf",  dest="pngpdf", help="Format of plot.", action="store")
+    parser.add_option("-p", "--pngpdf",  dest="pngpdf", help="Format of plot, comma separated for several.", action="store", default='png,pdf')
     (options, args) = parser.parse_args()
 
-
-    all_sdds = [sd for sd in os.listdir(options.sdds) if 'sdds' in sd]
-
-    beat = []
-    for sdds in all_sdds:
-        folder = os.path.join(options.phase, sdds)
-
-        beta_phase, beta_phase_err, bpms = read_bet_phase(folder, options.axis)
-        beta_amp, beta_amp_err = read_bet_amp(folder, options.axis)
-
-        beat = beat + [100*(beta_amp[i] - beta_phase[i])/beta_phase[i] for i in range(len(beta_phase)) if abs(100*(beta_amp[i] - beta_phase[i])/beta_phase[i]) <= 250 ] 
-
-    av = np.mean(beat)
-
-    plt.figure(figsize=(fix, fiy))
-    n, bins, patches  = plt.hist(beat, bins=200)
-    plt.plot(np.array([av,av]), np.array([0,max(n)]), ls='--', color = 'grey', lw = 2)
-    plt.ylim(0, max(n))
-    plt.tick_params('both', labelsize=size)
-    if options.axis == 'x': plt.xlabel(r'$(\beta_{x, amp}-\beta_{x, ph}) / \beta_{x, ph}$ [%]', fontsize=size)
-    else: plt.xlabel(r'$(\beta_{y, amp}-\beta_{y, ph}) / \beta_{y, ph}$ [%]', fontsize=size)
-    plt.ylabel('Counts', fontsize=size)
-    plt.tight_layout()
-    plt.savefig(options.sdds+'../BPMcalib_'+options.when+'_'+options.axis+'.'+options.pngpdf)
-    plt.close()
+    plot_calib_hist(options.sdds, options.phase, options.axis.split(','), options.when, options.pngpdf.split(','))
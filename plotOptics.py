@@ -1,84 +1,80 @@
 from optparse import OptionParser
 import numpy as np 
-import matplotlib.pyplot as plt
 import os
-import sys
+from func import load_tfs, map_jobs, pyplot
+plt = pyplot()
 
 
-def read_phase(ff):
-    with open(ff) as f: lines=f.readlines()
-    f.close()
-    S = [float(lines[10+i].split()[0]) for i in range(len(lines[10:]))]
-    deltaph = [float(lines[10+i].split()[8]) for i in range(len(lines[10:]))]
-    errdeltaph = [float(lines[10+i].split()[8]) for i in range(len(lines[10:]))]
+def read_phase(ff, axis):
+    table = load_tfs(ff)[1]
+    S = table['S']
+    deltaph = table['DELTAPHASE' + axis.upper()]
+    errdeltaph = table['ERRDELTAPHASE' + axis.upper()]
 
     return S, deltaph, errdeltaph
 
 
-def read_beta_amp(ff):
-    with open(ff) as f: lines=f.readlines()
-    f.close()
-    S = [float(lines[12+i].split()[1]) for i in range(len(lines[12:]))]
-    deltabet = np.array([float(lines[12+i].split()[7]) for i in range(len(lines[12:]))])*100
-    errdeltabet = np.array([float(lines[12+i].split()[8]) for i in range(len(lines[12:]))])*100
+def read_beta_amp(ff, axis):
+    table = load_tfs(ff)[1]
+    S = table['S']
+    deltabet = table['DELTABET' + axis.upper()]*100
+    errdeltabet = table['ERRDELTABET' + axis.upper()]*100
 
     return S, deltabet, errdeltabet
 
 
-def read_beta_ph(ff):
-    with open(ff) as f: lines=f.readlines()
-    f.close()
-    S = [float(lines[15+i].split()[1]) for i in range(len(lines[15:]))]
-    deltabet = np.array([float(lines[15+i].split()[10]) for i in range(len(lines[15:]))])*100
-    errdeltabet = np.array([float(lines[15+i].split()[11]) for i in range(len(lines[15:]))])*100
+def read_beta_ph(ff, axis):
+    table = load_tfs(ff)[1]
+    S = table['S']
+    deltabet = table['DELTABET' + axis.upper()]*100
+    errdeltabet = table['ERRDELTABET' + axis.upper()]*100
 
     return S, deltabet, errdeltabet
 
 
 def read_beta_cod(ff):
-    with open(ff) as f: lines=f.readlines()
-    f.close()
-    S = [float(lines[3+i].split()[1]) for i in range(len(lines[3:]))]
-    deltabetx = np.array([float(lines[3+i].split()[3]) for i in range(len(lines[3:]))])*100
-    deltabety = np.array([float(lines[3+i].split()[5]) for i in range(len(lines[3:]))])*100
+    table = load_tfs(ff)[1]
+    S = table['S']
+    deltabetx = table['DELTABETX']*100
+    deltabety = table['DELTABETY']*100
 
     return S, deltabetx, deltabety
 
 
 def read_disp_cod(ff):
-    with open(ff) as f: lines=f.readlines()
-    f.close()
-    S = [float(lines[3+i].split()[1]) for i in range(len(lines[3:]))]
-    dx = np.array([float(lines[3+i].split()[2]) for i in range(len(lines[3:]))])
-    dy = np.array([float(lines[3+i].split()[4]) for i in range(len(lines[3:]))])
+    table = load_tfs(ff)[1]
+    S = table['S']
+    dx = table['DX']
+    dy = table['DY']
 
     return S, dx, dy
 
 
-def read_norm_disp(ff):
-    with open(ff) as f: lines=f.readlines()
-    f.close()
-    S = [float(lines[10+i].split()[1]) for i in range(len(lines[10:]))]
-    ndx = [float(lines[10+i].split()[5]) for i in range(len(lines[10:]))]
-    errndx = [float(lines[10+i].split()[6]) for i in range(len(lines[10:]))]
-    dx = [float(lines[10+i].split()[10]) for i in range(len(lines[10:]))]
-    errdx = [float(lines[10+i].split()[11]) for i in range(len(lines[10:]))]
+def read_norm_disp(ff, axis):
+    table = load_tfs(ff)[1]
+    P = axis.upper()
+    S = table['S']
+    ndx = table['ND' + P]
+    errndx = table['ERRND' + P]
+    dx = table['D' + P]
+    errdx = table['ERRD' + P]
 
     return S, ndx, errndx, dx, errdx
 
 
-def read_disp(ff):
-    with open(ff) as f: lines=f.readlines()
-    f.close()
-    S = [float(lines[10+i].split()[1]) for i in range(len(lines[10:]))]
-    dx = [float(lines[10+i].split()[9]) for i in range(len(lines[10:]))]
-    errdx = [float(lines[10+i].split()[10]) for i in range(len(lines[10:]))]
-    deltadx = np.array([float(lines[10+i].split()[11]) for i in range(len(lines[10:]))])*100
-    errdeltadx = np.array([float(lines[10+i].split()[12]) for i in range(len(lines[10:]))])*100
-    try:
-        d2x = [float(lines[10+i].split()[16]) for i in range(len(lines[10:]))]
-        errd2x = [float(lines[10+i].split()[17]) for i in range(len(lines[10:]))]
-    except:
+def read_disp(ff, axis):
+    table = load_tfs(ff)[1]
+    P = axis.upper()
+    S = table['S']
+    dx = table['D' + P]
+    errdx = table['ERRD' + P]
+    deltadx = table['DELTAD' + P]*100
+    errdeltadx = table['ERRDELTAD' + P]*100
+    # second order dispersion, only written with --second_order_dispersion
+    if 'D2' + P in table:
+        d2x = table['D2' + P]
+        errd2x = table['ERRD2' + P]
+    else:
         d2x=[0]
         errd2x=[0]
 
@@ -86,21 +82,20 @@ def read_disp(ff):
 
 
 def read_model(ff):
-    with open(ff) as f: lines=f.readlines()
-    f.close()
-    Smdl = [float(lines[14+i].split()[2]) for i in range(len(lines[14:]))]
-    betxmdl = np.array([float(lines[14+i].split()[4]) for i in range(len(lines[14:]))])
-    betymdl = np.array([float(lines[14+i].split()[5]) for i in range(len(lines[14:]))])
-    dxmdl = np.array([float(lines[14+i].split()[12]) for i in range(len(lines[14:]))])
-    dymdl = np.array([float(lines[14+i].split()[13]) for i in range(len(lines[14:]))])
-    xmdl = np.array([float(lines[14+i].split()[16]) for i in range(len(lines[14:]))])
-    ymdl = np.array([float(lines[14+i].split()[17]) for i in range(len(lines[14:]))])
+    table = load_tfs(ff)[1]
+    Smdl = table['S']
+    betxmdl = table['BETX']
+    betymdl = table['BETY']
+    dxmdl = table['DX']
+    dymdl = table['DY']
+    xmdl = table['X']
+    ymdl = table['Y']
     
     return Smdl, betxmdl, betymdl, dxmdl, dymdl, xmdl, ymdl
 
 
 
-def plot_delta(direc, name, axis, S, delta, errdelta, pngpdf, num):
+def plot_delta(direc, name, axis, S, delta, errdelta, forms, num):
     fix = 12
     fiy = 5
     num = 1
@@ -126,14 +121,15 @@ def plot_delta(direc, name, axis, S, delta, errdelta, pngpdf, num):
         plt.ylabel(r'$\Delta \eta_{x}$/$\eta_{x}^{mdl}$ [%]', fontsize=size) if axis =='x' else plt.ylabel(r'$\Delta \eta_{y}$/$\eta_{y}^{mdl}$ [%]', fontsize=size) 
     plt.xlim(0, 3.016)
     plt.tight_layout()
-    plt.savefig(os.path.join(direc, name+'_'+axis+'_BEAT.'+pngpdf), bbox_inches='tight')
+    for form in forms:
+        plt.savefig(os.path.join(direc, name+'_'+axis+'_BEAT.'+form), bbox_inches='tight')
     plt.close(num)
     num=num+1
 
     return num
 
 
-def plot_abs(direc, name, axis, S, Smdl, val, errval, valmdl, pngpdf, num):
+def plot_abs(direc, name, axis, S, Smdl, val, errval, valmdl, forms, num):
     fix = 10
     fiy = 4
     num = 1
@@ -157,111 +153,135 @@ def plot_abs(direc, name, axis, S, Smdl, val, errval, valmdl, pngpdf, num):
     plt.xlim(0, 3.016)
     plt.legend(loc = 9, ncol = 2, fontsize=size, bbox_to_anchor=(0.5, 1.42), fancybox=True,  numpoints=1, scatterpoints = 1)
     plt.tight_layout()
-    plt.savefig(os.path.join(direc, name+'_'+axis+'_ABS.'+pngpdf), bbox_inches='tight')
+    for form in forms:
+        plt.savefig(os.path.join(direc, name+'_'+axis+'_ABS.'+form), bbox_inches='tight')
     plt.close(num)
     num=num+1
 
     return num
 
 
-def main():
-    parser = OptionParser()
-    parser.add_option("-d", "--dir",  dest="dir", help="Directory of optics analysis output")
-    parser.add_option("-m", "--model",  dest="model", help="Model file.")
-    parser.add_option("-r", "--ring",  dest="ring", help="Ring ID, HER or LER")
-    parser.add_option("-a", "--axis",  dest="axis", help="Plane, x or y")
-    parser.add_option("-p", "--pngpdf",  dest="pngpdf", help="Output format, PNG oder PDF")
-    parser.add_option("-f", "--allfiles", dest = "all_files_flag", help="Plot only the average optics")
-    (options, args) = parser.parse_args()
-    
-    num = 1
+def model_disp2(model_dir, axis):
+    """
+    Second order dispersion of the model from the closed orbit
+    of the off-momentum twiss files.
+    """
+    tw_files = sorted([ff for ff in os.listdir(model_dir) if 'twiss_dp0' in ff ], key=lambda ff: float(ff[len('twiss_dp0_'):-len('.dat')]))
+    dpp = np.arange(-1e-3, 1.1e-3, 1e-4)
+    orbit=[]
+    for ff in tw_files:
+        valmdl = read_model(os.path.join(model_dir, ff))
+        orbit.append(valmdl[5]) if axis == 'x' else orbit.append(valmdl[6])
+    orbit=np.transpose(orbit)
 
-    all_folders = os.listdir(options.dir)
+    d2mdl = []
+    dmdl = []
+    for i in range(len(orbit)):
 
-    if options.all_files_flag == "True":
-        all_folders = ['average']
+        diff1 = np.zeros(dpp.shape,float)
+        diff2 = np.zeros(dpp.shape,float)
 
-        if not os.path.exists(os.path.join(options.dir, 'average')): 
-            print(" ********************************************\n",
-                    "Plot optics:\n",
-                    'I could not find an average output folder..\n',
-                    'I stop now. \n',    
-                    "********************************************")
-            sys.exit()
+        diff1[0:-1] = np.diff(orbit[i])/np.diff(dpp)
+        diff1[-1] = (orbit[i][-1] - orbit[i][-2])/(dpp[-1] - dpp[-2])
+        diff2[0:-1] = np.diff(diff1)/np.diff(dpp)
+        diff2[-1] = (diff1[-1] - diff1[-2])/(dpp[-1] - dpp[-2])
+
+        dmdl.append(diff1[10])
+        d2mdl.append(diff2[10])
+
+    return d2mdl
 
-    for folder in all_folders:
-        print(folder)
-        files = [ff for ff in os.listdir(os.path.join(options.dir, folder)) if ('.tfs') in ff]
-        Smdl, betxmdl, betymdl, dxmdl, dymdl, xmdl, ymdl = read_model(os.path.join(options.model, 'twiss.dat'))
-    
 
+def plot_folder(task):
+    """
+    Plots the optics of one folder for each plane in axes, for
+    task = (optics_dir, folder, model_dir, axes, forms).
+    """
+    optics_dir, folder, model_dir, axes, forms = task
+    num = 1
+    print(folder)
+    files = [ff for ff in os.listdir(os.path.join(optics_dir, folder)) if ('.tfs') in ff]
+    Smdl, betxmdl, betymdl, dxmdl, dymdl, xmdl, ymdl = read_model(os.path.join(model_dir, 'twiss.dat'))
+
+    for axis in axes:
         if 'COD_betxy_muxy.tfs' in files:
-            S, deltabetx, deltabety = read_beta_cod(os.path.join(options.dir, 'average/COD_betxy_muxy.tfs'))
-            if options.axis == 'x':
-                num = plot_delta(os.path.join(options.dir, folder), 'COD_beta', options.axis, S, deltabetx, [0]*len(deltabetx), options.pngpdf, num)
+            S, deltabetx, deltabety = read_beta_cod(os.path.join(optics_dir, 'average/COD_betxy_muxy.tfs'))
+            if axis == 'x':
+                num = plot_delta(os.path.join(optics_dir, folder), 'COD_beta', axis, S, deltabetx, [0]*len(deltabetx), forms, num)
             else: 
-                num = plot_delta(os.path.join(options.dir, folder), 'COD_beta', options.axis, S, deltabety, [0]*len(deltabety), options.pngpdf, num)
+                num = plot_delta(os.path.join(optics_dir, folder), 'COD_beta', axis, S, deltabety, [0]*len(deltabety), forms, num)
 
         if 'COD_dxy.tfs' in files:
-            S, dx, dy = read_disp_cod(os.path.join(options.dir, 'average/COD_dxy.tfs'))
-            if options.axis == 'x':
-                num = plot_abs(os.path.join(options.dir, folder), 'COD_disp', options.axis, S, Smdl, dx, [0]*len(dx), dxmdl, options.pngpdf, num)
+            S, dx, dy = read_disp_cod(os.path.join(optics_dir, 'average/COD_dxy.tfs'))
+            if axis == 'x':
+                num = plot_abs(os.path.join(optics_dir, folder), 'COD_disp', axis, S, Smdl, dx, [0]*len(dx), dxmdl, forms, num)
             else: 
-                num = plot_abs(os.path.join(options.dir, folder), 'COD_disp', options.axis, S, Smdl, dy, [0]*len(dx), dymdl, options.pngpdf, num)
-        
-        if 'phase_'+options.axis+'.tfs' in files:
-            S, deltaph, errdeltaph = read_phase(os.path.join(options.dir, 'average/phase_'+options.axis+'.tfs'))
-            num = plot_delta(os.path.join(options.dir, folder), 'phase', options.axis, S, deltaph, errdeltaph, options.pngpdf, num)
-
-        if 'beta_amplitude_'+options.axis+'.tfs' in files:
-            S, deltabet, errdeltabet = read_beta_amp(os.path.join(options.dir, 'average/beta_amplitude_'+options.axis+'.tfs'))
-            num = plot_delta(os.path.join(options.dir, folder), 'beta_amp', options.axis, S, deltabet, errdeltabet, options.pngpdf, num)
-        
-        if 'beta_phase_'+options.axis+'.tfs' in files:
-            S, deltabet, errdeltabet = read_beta_ph(os.path.join(options.dir, 'average/beta_phase_'+options.axis+'.tfs'))
-            num = plot_delta(os.path.join(options.dir, folder), 'beta_ph', options.axis, S, deltabet, errdeltabet, options.pngpdf, num)
-        
-        if 'normalised_dispersion_'+options.axis+'.tfs' in files:
-            S, ndx, errndx, dx, errdx = read_norm_disp(os.path.join(options.dir, 'average/normalised_dispersion_'+options.axis+'.tfs'))
-            ndmdl = dxmdl/np.sqrt(betxmdl) if options.axis == 'x' else dymdl/np.sqrt(betymdl)
-            num = plot_abs(os.path.join(options.dir, folder), 'norm_disp', options.axis, S, Smdl, ndx, errndx, ndmdl, options.pngpdf, num)
-
-        if 'dispersion_'+options.axis+'.tfs' in files:
-            dmdl = dxmdl if options.axis == 'x' else dymdl
-            S, dx, errdx, deltadx, errdeltadx, d2x, errd2x = read_disp(os.path.join(options.dir, 'average/dispersion_'+options.axis+'.tfs'))
-            num = plot_delta(os.path.join(options.dir, folder), 'disp', options.axis, S, deltadx, errdeltadx, options.pngpdf, num)
-            num = plot_abs(os.path.join(options.dir, folder), 'disp', options.axis, S, Smdl, dx, errdx, dmdl, options.pngpdf, num)
+                num = plot_abs(os.path.join(optics_dir, folder), 'COD_disp', axis, S, Smdl, dy, [0]*len(dx), dymdl, forms, num)
+
+        if 'phase_'+axis+'.tfs' in files:
+            S, deltaph, errdeltaph = read_phase(os.path.join(optics_dir, 'average/phase_'+axis+'.tfs'), axis)
+            num = plot_delta(os.path.join(optics_dir, folder), 'phase', axis, S, deltaph, errdeltaph, forms, num)
+
+        if 'beta_amplitude_'+axis+'.tfs' in files:
+            S, deltabet, errdeltabet = read_beta_amp(os.path.join(optics_dir, 'average/beta_amplitude_'+axis+'.tfs'), axis)
+            num = plot_delta(os.path.join(optics_dir, folder), 'beta_amp', axis, S, deltabet, errdeltabet, forms, num)
+
+        if 'beta_phase_'+axis+'.tfs' in files:
+            S, deltabet, errdeltabet = read_beta_ph(os.path.join(optics_dir, 'average/beta_phase_'+axis+'.tfs'), axis)
+            num = plot_delta(os.path.join(optics_dir, folder), 'beta_ph', axis, S, deltabet, errdeltabet, forms, num)
+
+        if 'normalised_dispersion_'+axis+'.tfs' in files:
+            S, ndx, errndx, dx, errdx = read_norm_disp(os.path.join(optics_dir, 'average/normalised_dispersion_'+axis+'.tfs'), axis)
+            ndmdl = dxmdl/np.sqrt(betxmdl) if axis == 'x' else dymdl/np.sqrt(betymdl)
+            num = plot_abs(os.path.join(optics_dir, folder), 'norm_disp', axis, S, Smdl, ndx, errndx, ndmdl, forms, num)
+
+        if 'dispersion_'+axis+'.tfs' in files:
+            dmdl = dxmdl if axis == 'x' else dymdl
+            S, dx, errdx, deltadx, errdeltadx, d2x, errd2x = read_disp(os.path.join(optics_dir, 'average/dispersion_'+axis+'.tfs'), axis)
+            num = plot_delta(os.path.join(optics_dir, folder), 'disp', axis, S, deltadx, errdeltadx, forms, num)
+            num = plot_abs(os.path.join(optics_dir, folder), 'disp', axis, S, Smdl, dx, errdx, dmdl, forms, num)
 
             if len(d2x) > 1:
-                tw_files = [ff for ff in os.listdir(options.model) if 'twiss_dp0' in ff ]
-                dpp = np.arange(-1e-3, 1.1e-3, 1e-4)
-                orbit=[]
-                for ff in tw_files:
-                    valmdl = read_model(os.path.join(options.model, ff))
-                    orbit.append(valmdl[5]) if options.axis == 'x' else orbit.append(valmdl[6])
-                orbit=np.transpose(orbit)
-                
-                d2mdl = []
-                dmdl = []
-                for i in range(len(orbit)):
-                    
-                    diff1 = np.zeros(dpp.shape,np.float)
-                    diff2 = np.zeros(dpp.shape,np.float)
-                    
-                    diff1[0:-1] = np.diff(orbit[i])/np.diff(dpp)
-                    diff1[-1] = (orbit[i][-1] - orbit[i][-2])/(dpp[-1] - dpp[-2])
-                    diff2[0:-1] = np.diff(diff1)/np.diff(dpp)
-                    diff2[-1] = (diff1[-1] - diff1[-2])/(dpp[-1] - dpp[-2])
-
-                    dmdl.append(diff1[10])
-                    d2mdl.append(diff2[10])
-
-                num = plot_abs(os.path.join(options.dir, folder), 'disp2', options.axis, S, Smdl, d2x, errd2x, d2mdl, options.pngpdf, num)
-            
+                d2mdl = model_disp2(model_dir, axis)
+                num = plot_abs(os.path.join(optics_dir, folder), 'disp2', axis, S, Smdl, d2x, errd2x, d2mdl, forms, num)
 
-if __name__ == "__main__":
-    main()
 
+def plot_optics(optics_dir, model_dir, axes=('x', 'y'), all_files_flag=False, forms=('png', 'pdf'), jobs=1):
+    """
+    Plots the optics of all folders in optics_dir (only the average with all_files_flag)
+    for each plane in axes, the folders are plotted by jobs processes.
+    The model and the optics files are read once per process, each figure
+    is saved once per format in forms.
+    """
+    all_folders = os.listdir(optics_dir)
+
+    if all_files_flag:
+        all_folders = ['average']
+
+        if not os.path.exists(os.path.join(optics_dir, 'average')): 
+            print(" ********************************************\n",
+                    "Plot optics:\n",
+                    'I could not find an average output folder..\n',
+                    'I stop now. \n',    
+                    "********************************************")
+            return
 
+    map_jobs(plot_folder, [(optics_dir, folder, model_dir, axes, forms) for folder in all_folders], jobs)
 
 
+def main():
+    parser = OptionParser()
+    parser.add_option("-d", "--dir",  dest="dir", help="Directory of optics analysis output")
+    parser.add_option("-m", "--model",  dest="model", help="Model file.")
+    parser.add_option("-r", "--ring",  dest="ring", help="Ring ID, HER or LER")
+    parser.add_option("-a", "--axis",  dest="axis", help="Plane, x or y, comma separated for both", default='x,y')
+    parser.add_option("-p", "--pngpdf",  dest="pngpdf", help="Output format, PNG oder PDF, comma separated for both", default='png,pdf')
+    parser.add_option("-f", "--allfiles", dest = "all_files_flag", help="Plot only the average optics")
+    parser.add_option("-j", "--jobs", dest = "jobs", help="Number of processes plotting the folders", type=int, default=1)
+    (options, args) = parser.parse_args()
+
+    plot_optics(options.dir, options.model, options.axis.split(','), options.all_files_flag == "True", options.pngpdf.split(','), options.jobs)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,42 +1,36 @@
 """
 Script to plot orbit data from sdds files.
+The files are plotted by a pool of processes, one pdf per file.
 """
 
 from __future__ import print_function
 from optparse import OptionParser
 import numpy as np 
-import matplotlib.pyplot as plt
 import os
+from func import list_sdds, map_jobs, pyplot, read_first_bpms
+plt = pyplot()
 from matplotlib.backends.backend_pdf import PdfPages
 
 
-
-if __name__ == "__main__":
-
+def plot_positions(sdds_file):
+    """
+    Plots the orbit over turns of the first two BPMs of each plane
+    of sdds_file to <sdds_file>_PosPlot.pdf.
+    """
     fix = 10
     fiy = 3.5
     size = 20
-    
-    parser = OptionParser()
-    parser.add_option("-s", "--sdds",  dest="sdds", help="Folder of sdds files, leads to other folders.", action="store")
-    parser.add_option("-p", "--pngpdf",  dest="pngpdf", help="Format of plot.", action="store")
-    (options, args) = parser.parse_args()
-
-    all_sdds = [sd for sd in os.listdir(options.sdds) if '.sdds' in sd[-5:]]
 
-    num=1
-    for sdds in all_sdds:
-        print(sdds)
-        with open(os.path.join(options.sdds, sdds)) as fo:
-            lines = fo.readlines()[11:]
-        fo.close()
+    print(os.path.basename(sdds_file))
+    tbt = read_first_bpms(sdds_file, 2)
 
-        with PdfPages(os.path.join(options.sdds, str(sdds)+'_PosPlot.pdf')) as pdf:
-            for ll in range(len(lines[:4])):
-                axis = 'x' if lines[ll].split()[0] == '0' else 'y'
-                bpm = lines[ll].split()[1]
+    with PdfPages(sdds_file+'_PosPlot.pdf') as pdf:
+        for ll in range(2):
+            for axis in ['x', 'y']:
+                names, S, data = tbt[axis]
+                bpm = names[ll]
                 print(bpm)
-                orbit = [ float(lines[ll].split()[(3+i)]) for i in range(len(lines[ll].split()[3:])) if (lines[ll].split()[(3+i)] != '0') ]
+                orbit = data[ll][data[ll] != 0]
                 turns = np.array(range(len(orbit)))
                 plt.figure(figsize=(fix, fiy))
                 plt.scatter(turns, orbit, s=5, marker='o')
@@ -48,9 +42,21 @@ if __name__ == "__main__":
                 #plt.savefig(os.path.join(options.sdds, str(sdds[:-5])+'_'+str(bpm)+'_'+str(axis)+'.'+options.pngpdf))
                 pdf.savefig()
                 plt.close()
-                #num=num+1
-        
-           # quit()
-            
-        
-    
+
+
+def plot_sdds(sdds_dir, jobs=1):
+    """
+    Plots the orbit of all sdds files in sdds_dir, using jobs processes.
+    """
+    map_jobs(plot_positions, [os.path.join(sdds_dir, sdds) for sdds in list_sdds(sdds_dir)], jobs)
+
+
+if __name__ == "__main__":
+
+    parser = OptionParser()
+    parser.add_option("-s", "--sdds",  dest="sdds", help="Folder of sdds files, leads to other folders.", action="store")
+    parser.add_option("-p", "--pngpdf",  dest="pngpdf", help="Format of plot.", action="store")
+    parser.add_option("-j", "--jobs",  dest="jobs", help="Number of processes rendering the plots.", action="store", type=int, default=1)
+    (options, args) = parser.parse_args()
+
+    plot_sdds(options.sdds, options.jobs)
@@ -0,0 +1,80 @@
+"""
+Statistics of measurements which contain outliers, e.g. the BPM x run
+matrices of the calibration, coupling and beta-beating analysis.
+All functions work along one axis of a 2-D array (axis=None for all
+values at once), NaN entries and masked entries are left out.
+"""
+
+import warnings
+import numpy as np
+
+
+MAD_TO_STD = 1.4826
+
+
+def valid(values):
+    """
+    Returns values as masked array of floats with NaN and inf masked.
+    """
+    return np.ma.masked_invalid(np.ma.asarray(values, dtype=float))
+
+
+def sigma_clip(values, m=2, axis=0, iterations=1):
+    """
+    Returns values as masked array without the entries farther than
+    m*stddev away from the mean along axis. The mean and stddev are
+    computed again from the kept entries up to iterations times, or
+    until nothing changes any more (iterations=None).
+    One iteration is the same as func.reject_outliers.
+    """
+    clipped = valid(values)
+    done = 0
+    while iterations is None or done < iterations:
+        center = clipped.mean(axis=axis, keepdims=True)
+        spread = clipped.std(axis=axis, keepdims=True)
+        keep = np.ma.filled(np.ma.abs(clipped - center) < m*spread, False)
+        if np.array_equal(keep, ~np.ma.getmaskarray(clipped)):
+            break
+        clipped = np.ma.masked_array(clipped.data, mask=~keep)
+        done += 1
+    return clipped
+
+
+def clipped_mean(values, m=2, axis=0, iterations=1, fill=np.nan):
+    """
+    Mean along axis of the values kept by sigma_clip,
+    fill where no value is left.
+    """
+    return np.ma.filled(sigma_clip(values, m, axis, iterations).mean(axis=axis), fill)
+
+
+def median_mad(values, axis=0, scale=MAD_TO_STD):
+    """
+    Returns the median along axis and the median absolute deviation
+    from it, times scale (the stddev for normally distributed values).
+    NaN where there are no values.
+    """
+    data = np.ma.filled(valid(values), np.nan)
+    with warnings.catch_warnings():
+        # rows or columns without any value have no median
+        warnings.simplefilter('ignore', RuntimeWarning)
+        median = np.nanmedian(data, axis=axis, keepdims=True)
+        mad = scale*np.nanmedian(np.abs(data - median), axis=axis)
+    return np.squeeze(median, axis=axis), mad
+
+
+def weighted_mean(values, errors, axis=0):
+    """
+    Returns the mean along axis weighted by 1/errors**2 and its error
+    1/sqrt(sum of the weights). Entries without value or with an error
+    which is not positive are left out, NaN where nothing is left.
+    """
+    data = valid(values)
+    errors = valid(errors)
+    weights = np.ma.filled(1./errors**2, 0.)
+    weights = np.where(np.ma.getmaskarray(data) | (np.ma.filled(errors, 0.) <= 0), 0., weights)
+    total = weights.sum(axis=axis)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = np.sum(weights*np.ma.filled(data, 0.), axis=axis) / total
+        error = 1./np.sqrt(total)
+    return np.where(total > 0, mean, np.nan), np.where(total > 0, error, np.nan)
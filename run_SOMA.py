@@ -6,10 +6,14 @@ from __future__ import print_function
 import argparse
 import os
 import sys
+import time
 
 from func import read_parameters, sdds_conv, harmonic_analysis, optics_analysis, asynch_analysis
 from func import asynch_cmap, bpm_calibration, calib_hist, freq_spec, chromatic_analysis
 from func import plot_optics, coupling_analysis, sdds_turns, cut_large_sdds, makemodel_and_guesstune
+from func import model_from_cache, convert_tbt, read_dict, list_sdds, conversion_sources
+from func import generic_dict, new_data_files, extend_dict
+from pipeline import stage, run_pipeline
 
 parser = argparse.ArgumentParser()
 required = parser.add_argument_group('required arguments')
@@ -83,6 +87,64 @@ parser.add_argument('--plotcalib2', '-pc2',
 parser.add_argument('--omc3', '-omc3',
                     action='store_true',
                     help='Use OMC3/python3 instead of BetaBeat.src/python2.')
+parser.add_argument('--inprocess',
+                    action='store_true',
+                    help='With --omc3, imports omc3 once and runs harpy and optics in this process (or a pool of --jobs processes).')
+parser.add_argument('--harmonic_engine',
+                    action='store',
+                    choices=['harpy', 'numpy'],
+                    default='harpy',
+                    help='Harmonic analysis with harpy (OMC3/BetaBeat.src) or with the numpy engine of harmonicNumpy.py.')
+parser.add_argument('--model_scan',
+                    action='store',
+                    choices=['session', 'parallel'],
+                    default='session',
+                    help='Off-momentum model scan in one SAD session or split over --jobs SAD sessions.')
+parser.add_argument('--cut_window',
+                    action='store',
+                    type=int,
+                    default=5000,
+                    help='Number of turns per file when cutting sdds files of 50k turns.')
+parser.add_argument('--cut_overlap',
+                    action='store',
+                    type=int,
+                    default=0,
+                    help='Number of turns shared by consecutive cut sdds files.')
+parser.add_argument('--tbt',
+                    action='store_true',
+                    help='Writes a binary, memory-mappable copy of the converted sdds files (<file>.sdds.tbt).')
+parser.add_argument('--tbt_dtype',
+                    action='store',
+                    choices=['float32', 'float64'],
+                    default='float64',
+                    help='Precision of the binary sdds copy.')
+parser.add_argument('--average', '-av',
+                    action='store_true',
+                    help='Runs the all files optics analysis into average/ together with the single file analyses.')
+parser.add_argument('--on_existing', '--on-existing',
+                    action='store',
+                    dest='on_existing',
+                    choices=['reuse', 'clean', 'update', 'fail'],
+                    help='What to do with existing sdds files and models without asking: reuse, clean (convert or create again), update (convert only outdated sdds files) or fail.')
+parser.add_argument('--consensus',
+                    action='store_true',
+                    help='Converts all files of convert2 with the BPM offsets most runs agree on (outofphase<axis>/consensus.txt) instead of the offsets of each run.')
+parser.add_argument('--watch',
+                    action='store_true',
+                    help='Keeps running and analyses every new .data file in input_data_path (by default up to optics1).')
+parser.add_argument('--poll',
+                    action='store',
+                    type=float,
+                    default=5,
+                    help='Seconds between two checks of input_data_path in --watch mode.')
+parser.add_argument('--force',
+                    action='store_true',
+                    help='Rebuilds all outputs of the requested stages, also if they are up to date.')
+parser.add_argument('--jobs', '-j',
+                    action='store',
+                    type=int,
+                    default=1,
+                    help='Number of files analysed at the same time, per-file logs are written when larger than 1.')
 args = parser.parse_args()
 
 # Read in destinations
@@ -97,6 +159,7 @@ kickax = parameters["kickax"]
 
 # For BetaBeat.src
 model_path = parameters["model_path"]
+model_cache_path = parameters.get("model_cache_path")
 
 # For present code
 main_output = parameters["main_output_path"]
@@ -129,103 +192,184 @@ else:
     BetaBeatsrc_path = parameters["BetaBeatsrc_path"]
 
 
-# First SDDS conversion
-if args.convert1 or args.harmonic1:
-    sdds_conv(input_data, file_dict, main_output, unsynched_sdds,
-              lattice, gsad, ringID, kickax, asynch_info=False)
-
-    cut_large_sdds(python_exe, unsynched_sdds)
-
-# Create a model to be used by hole in one
-if args.model or args.harmonic1 or args.harmonic2:
-    makemodel_and_guesstune(model_path, lattice, gsad)
-
-# First harmonic analysis with unsynced BPMs
-if args.harmonic1:
-    harmonic_analysis(py_version, python_exe, BetaBeatsrc_path, model_path,
-                      unsynched_harmonic_output, unsynched_sdds,
-                      nturns, str(0.04), lattice, gsad)
-
-if args.plotsdds1:
-    sdds_turns(python_exe, unsynched_sdds)
-
-if args.plotfreq1:
-    freq_spec(python_exe, unsynched_sdds, model_path)
-
-# Optics analysis 1, before synchronization
-if args.optics1:
-    optics_analysis(py_version, python_exe, BetaBeatsrc_path, model_path,
-                   unsynched_harmonic_output, unsynched_optics_output, unsynched_sdds, 
-                   ringID, args.all_files)
-    try: chromatic_analysis(model_path, unsynched_optics_output)         
-    except: pass
-
-# Asynch analysis
-if args.asynch:
-    asynch_analysis(python_exe, unsynched_optics_output, main_output, model_path, ringID)
-
-# Plotting BPM synchronisation pre-fix
-if args.plotasynch1:
-    asynch_cmap(python_exe, unsynched_sdds, unsynched_optics_output, when='before')
-
-# Second sdds conversion (with knowledge of BPM synch)
-if args.convert2 or args.harmonic2:
-    sdds_conv(input_data, file_dict, main_output, synched_sdds,
-              lattice, gsad, ringID, kickax, asynch_info=True)
-
-    cut_large_sdds(python_exe, synched_sdds)
-
-# Second harmonic analysis with synced BPMs
-if args.harmonic2:
-    harmonic_analysis(py_version, python_exe, BetaBeatsrc_path, model_path,
-                      synched_harmonic_output, synched_sdds,
-                      nturns, str(0.04), lattice, gsad)
-
-if args.plotsdds2:
-    sdds_turns(python_exe, synched_sdds)
-
-if args.plotfreq2:
-    freq_spec(python_exe, synched_sdds, model_path)
-
-# Phase analysis 2
-if args.optics2:
-    optics_analysis(py_version, python_exe, BetaBeatsrc_path, model_path,
-                   synched_harmonic_output, synched_optics_output, synched_sdds, 
-                   ringID, args.all_files)
-    try: chromatic_analysis(model_path, synched_optics_output)    
-    except: pass
-    try: coupling_analysis(model_path, synched_sdds, synched_harmonic_output, synched_optics_output, args.all_files)
-    except: pass
-
-if args.plotoptics2:
-    plot_optics(python_exe, synched_optics_output, model_path, ringID, args.all_files)
-
-# Plotting BPM synchronisation post-fix
-if args.plotasynch2:
-    asynch_cmap(python_exe, synched_sdds, synched_optics_output, when='after')
-
-# Plotting BPM calibration pre-calib
-if args.plotcalib1:
-    calib_hist(python_exe, synched_sdds, synched_optics_output, when='before')
-
-# Calculation of BPM calibration and writing lin files and calib harmonic folder
-if args.calib:
-    bpm_calibration(python_exe, synched_sdds, ringID)
-
-# Phase analysis 3, with calibrated BPMs
-if args.optics3:
-    optics_analysis(py_version, python_exe, BetaBeatsrc_path, model_path,
-                   calibrated_harmonic_output, calibrated_optics_output, synched_sdds, 
-                   ringID, args.all_files)
-    try: chromatic_analysis(model_path, calibrated_optics_output)
-    except: pass
-
-if args.plotoptics3:
-    plot_optics(python_exe, calibrated_optics_output, model_path, ringID, args.all_files)
-
-# Plotting BPM calibration post-calib
-if args.plotcalib2:
-    calib_hist(python_exe, synched_sdds, calibrated_optics_output, when='after')
+def lin_files(harmonic_output, run):
+    """
+    Harmonic analysis output of one sdds file.
+    """
+    sep = '.' if py_version > 2 else '_'
+    return [os.path.join(harmonic_output, run + sep + 'lin' + plane) for plane in ['x', 'y']]
+
+
+def optics_files(optics_output, run, names):
+    """
+    Files of the optics analysis of one run, by their omc3 name (e.g. total_phase_x.tfs),
+    or the Beta-Beat.src equivalent.
+    """
+    py2_names = {'total_phase': 'getphasetot', 'beta_phase': 'getbeta', 'beta_amplitude': 'getampbeta'}
+    files = []
+    for name in names:
+        for plane in ['x', 'y']:
+            if py_version > 2:
+                files.append(os.path.join(optics_output, run, name + '_' + plane + '.tfs'))
+            else:
+                files.append(os.path.join(optics_output, run, py2_names[name] + plane + '.out'))
+    return files
+
+
+def sdds_runs(sdds_dir):
+    return sorted(list_sdds(sdds_dir)) if os.path.exists(sdds_dir) else []
+
+
+def conversion_units(sdds_dir, asynch_info):
+    """
+    One unit per file in file_dict, made from its own .data file (and
+    outofphase file). file_dict itself is no input, files added to it
+    are new units. With --on_existing reuse existing sdds files are kept.
+    """
+    if not os.path.exists(file_dict):
+        return [('file_dict', [], [])]
+    fbpm_dir = os.path.join(main_output, 'outofphase' + kickax.lower()) if asynch_info else None
+    units = []
+    for data, sdds in read_dict(file_dict):
+        output = os.path.join(sdds_dir, sdds)
+        if args.on_existing == 'reuse' and os.path.isfile(output):
+            inputs = []
+        else:
+            inputs = conversion_sources(data, sdds, fbpm_dir, args.consensus)
+        units.append((sdds, inputs, [output]))
+    return units
+
+
+def harmonic_units(sdds_dir, harmonic_output):
+    twiss = os.path.join(model_path, 'twiss.dat')
+    return [(run, [os.path.join(sdds_dir, run), twiss], lin_files(harmonic_output, run))
+            for run in sdds_runs(sdds_dir)]
+
+
+def optics_units(sdds_dir, harmonic_output, optics_output):
+    runs = sdds_runs(sdds_dir)
+    units = []
+    if not args.all_files:
+        units = [(run, lin_files(harmonic_output, run), [os.path.join(optics_output, run)]) for run in runs]
+    if args.all_files or args.average:
+        units.append(('average', [ff for run in runs for ff in lin_files(harmonic_output, run)],
+                      [os.path.join(optics_output, 'average')]))
+    return units
+
+
+def plot_units():
+    return [('plots', [], [])]
+
+
+def convert(sdds_dir, asynch_info):
+    def run(units):
+        # exactly the stale units are converted, all of file_dict once it is created
+        sdds_conv(input_data, file_dict, main_output, sdds_dir,
+                  lattice, gsad, ringID, kickax, asynch_info=asynch_info, on_existing=args.on_existing or 'update', jobs=args.jobs,
+                  consensus=args.consensus, files=None if 'file_dict' in units else units)
+        cut_large_sdds(sdds_dir, args.cut_window, args.cut_overlap)
+        if args.tbt:
+            convert_tbt(sdds_dir, args.tbt_dtype)
+    return run
+
+
+def model(units):
+    if model_cache_path:
+        model_from_cache(model_path, lattice, gsad, model_cache_path, args.model_scan, args.jobs)
+    else:
+        # nobody answers questions while watching
+        on_existing = args.on_existing or ('reuse' if args.watch else None)
+        makemodel_and_guesstune(model_path, lattice, gsad, args.model_scan, args.jobs, on_existing)
+
+
+def harmonic(sdds_dir, harmonic_output):
+    def run(units):
+        harmonic_analysis(py_version, python_exe, BetaBeatsrc_path, model_path,
+                          harmonic_output, sdds_dir,
+                          nturns, str(0.04), lattice, gsad, args.jobs, files=units,
+                          engine=args.harmonic_engine, inprocess=args.inprocess, tbt=args.tbt)
+    return run
+
+
+def optics(sdds_dir, harmonic_output, optics_output, coupling=False):
+    def run(units):
+        optics_analysis(py_version, python_exe, BetaBeatsrc_path, model_path,
+                        harmonic_output, optics_output, sdds_dir,
+                        ringID, args.all_files, args.jobs, 'average' in units,
+                        files=[unit for unit in units if unit != 'average'], inprocess=args.inprocess)
+        try: chromatic_analysis(model_path, optics_output)
+        except: pass
+        if coupling:
+            try: coupling_analysis(model_path, sdds_dir, harmonic_output, optics_output, args.all_files)
+            except: pass
+    return run
+
+
+# Stages in the order of their dependencies, see README.md
+stages = [
+    stage('convert1', lambda: conversion_units(unsynched_sdds, False), convert(unsynched_sdds, False)),
+    stage('model', lambda: [('model', [lattice], [os.path.join(model_path, 'twiss.dat')])], model),
+    stage('harmonic1', lambda: harmonic_units(unsynched_sdds, unsynched_harmonic_output),
+          harmonic(unsynched_sdds, unsynched_harmonic_output), requires=['convert1', 'model']),
+    stage('plotsdds1', plot_units, lambda units: sdds_turns(unsynched_sdds, args.jobs), requires=['convert1']),
+    stage('plotfreq1', plot_units, lambda units: freq_spec(unsynched_sdds, model_path, args.jobs), requires=['convert1', 'model']),
+    stage('optics1', lambda: optics_units(unsynched_sdds, unsynched_harmonic_output, unsynched_optics_output),
+          optics(unsynched_sdds, unsynched_harmonic_output, unsynched_optics_output), requires=['harmonic1']),
+    stage('asynch', lambda: [('asynch', [ff for run in sdds_runs(unsynched_sdds) for ff in optics_files(unsynched_optics_output, run, ['total_phase'])],
+                              [os.path.join(main_output, 'outofphase' + plane, run + '.txt') for plane in ['x', 'y'] for run in sdds_runs(unsynched_sdds) + ['consensus']])],
+          lambda units: asynch_analysis(unsynched_optics_output, main_output, model_path, ringID), requires=['optics1']),
+    stage('plotasynch1', plot_units, lambda units: asynch_cmap(unsynched_sdds, unsynched_optics_output, when='before'), requires=['optics1']),
+    stage('convert2', lambda: conversion_units(synched_sdds, True), convert(synched_sdds, True), requires=['asynch']),
+    stage('harmonic2', lambda: harmonic_units(synched_sdds, synched_harmonic_output),
+          harmonic(synched_sdds, synched_harmonic_output), requires=['convert2', 'model']),
+    stage('plotsdds2', plot_units, lambda units: sdds_turns(synched_sdds, args.jobs), requires=['convert2']),
+    stage('plotfreq2', plot_units, lambda units: freq_spec(synched_sdds, model_path, args.jobs), requires=['convert2', 'model']),
+    stage('optics2', lambda: optics_units(synched_sdds, synched_harmonic_output, synched_optics_output),
+          optics(synched_sdds, synched_harmonic_output, synched_optics_output, coupling=True), requires=['harmonic2']),
+    stage('plotoptics2', plot_units, lambda units: plot_optics(synched_optics_output, model_path, ringID, args.all_files, args.jobs), requires=['optics2']),
+    stage('plotasynch2', plot_units, lambda units: asynch_cmap(synched_sdds, synched_optics_output, when='after'), requires=['optics2']),
+    stage('plotcalib1', plot_units, lambda units: calib_hist(synched_sdds, synched_optics_output, when='before'), requires=['optics2']),
+    stage('calib', lambda: [('calib', [ff for run in sdds_runs(synched_sdds) for ff in optics_files(synched_optics_output, run, ['beta_phase', 'beta_amplitude'])
+                                       + lin_files(synched_harmonic_output, run)],
+                             [ff for run in sdds_runs(synched_sdds) for ff in lin_files(calibrated_harmonic_output, run)]
+                             + [os.path.join(main_output, 'calibration_' + plane + '.tfs') for plane in ['x', 'y']])],
+          lambda units: bpm_calibration(synched_sdds, ringID, args.jobs), requires=['optics2']),
+    stage('optics3', lambda: optics_units(synched_sdds, calibrated_harmonic_output, calibrated_optics_output),
+          optics(synched_sdds, calibrated_harmonic_output, calibrated_optics_output), requires=['calib']),
+    stage('plotoptics3', plot_units, lambda units: plot_optics(calibrated_optics_output, model_path, ringID, args.all_files, args.jobs), requires=['optics3']),
+    stage('plotcalib2', plot_units, lambda units: calib_hist(synched_sdds, calibrated_optics_output, when='after'), requires=['optics3']),
+]
+
+# Every requested stage, with the stages it depends on where they are out of date
+targets = [st['name'] for st in stages if getattr(args, st['name'])]
+state_file = os.path.join(main_output, '.pipeline_state')
+
+if args.watch:
+    # New files are converted and analysed up to the single file optics, unless other steps are requested
+    targets = targets or ['optics1']
+    if not os.path.exists(file_dict):
+        generic_dict(input_data, file_dict, ringID)
+    run_pipeline(stages, targets, state_file, args.force)
+    print(" ********************************************\n",
+          "Watching " + input_data + ' for new .data files every ' + str(args.poll) + ' s.\n',
+          "Stop with Ctrl-C.\n",
+          "********************************************")
+    sizes = {}
+    try:
+        while True:
+            new = new_data_files(input_data, file_dict, ringID)
+            # Files are only taken once their size did not change since the last poll
+            ready = [ff for ff in new if sizes.get(ff) == os.path.getsize(os.path.join(input_data, ff))]
+            sizes = dict((ff, os.path.getsize(os.path.join(input_data, ff))) for ff in new)
+            if ready:
+                print('New files: ' + ', '.join(ready))
+                extend_dict(input_data, file_dict, ready)
+                run_pipeline(stages, targets, state_file)
+            time.sleep(args.poll)
+    except KeyboardInterrupt:
+        print('Stopped watching ' + input_data + '.')
+else:
+    run_pipeline(stages, targets, state_file, args.force)
 
 
 print(" ********************************************\n",